@@ -1,20 +1,37 @@
 import json
+import multiprocessing
 import os
+import queue
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import tensorflow as tf
 import numpy as np
 import random
-from layers_object import conv_layer, up_sampling, max_pool, initialization, \
+import scipy.misc
+from layers_object import conv_block, up_sampling, max_pool, initialization, \
     variable_with_weight_decay
-from evaluation_object import normal_loss, per_class_acc, get_hist, print_hist_summary, train_op
-from inputs_object import get_filename_list, dataset_inputs, get_all_test_data
-from drawings_object import draw_plots
+from evaluation_object import normal_loss, print_hist_summary, hist_metrics, train_op, accumulating_train_op, \
+    confusion_matrix, streaming_confusion_matrix
+from inputs_object import get_filename_list, dataset_inputs, packed_dataset_inputs, make_dataset, \
+    make_packed_dataset, get_all_test_data
+from drawings_object import draw_plots, colour_image
+from uncertainty_object import RunningMoments
+from tiling_object import tile_positions, blend_weights
 
 
 class SegNet:
-    def __init__(self, conf_file="config.json"):
+    def __init__(self, conf_file="config.json", config_overrides=None, device=None):
         with open(conf_file) as f:
             self.config = json.load(f)
+        # config_overrides: dict of config keys to replace, e.g. to build the same model with another BATCH_SIZE
+        self.config.update(config_overrides or {})
+        # device: device (or device function) for the model ops and variables, e.g. the replica_device_setter of
+        # distributed_object
+        self.device = device
 
         self.num_classes = self.config["NUM_CLASSES"]
         self.use_vgg = self.config["USE_VGG"]
@@ -39,6 +56,14 @@ class SegNet:
         self.input_c = self.config["INPUT_CHANNELS"]
         self.tb_logs = self.config["TB_LOGS"]
         self.batch_size = self.config["BATCH_SIZE"]
+        # batch size of the Monte Carlo dropout runs, independent of BATCH_SIZE since the graph has no fixed batch
+        self.mc_batch_size = self.config.get("MC_BATCH_SIZE", 10)
+        self.unpool_mode = self.config.get("UNPOOL_MODE", "scatter")
+        self.compute_dtype = tf.as_dtype(self.config.get("PRECISION", "float32"))
+        if self.compute_dtype == tf.bfloat16 and not tf.test.is_gpu_available():
+            # the CPU kernels of conv2d and the fused batch norm have no bfloat16 version
+            raise ValueError("PRECISION bfloat16 is not supported on CPU, use float16 or float32")
+        self.recompute_blocks = self.config.get("RECOMPUTE_BLOCKS", [])
 
         self.train_loss, self.train_accuracy = [], []
         self.val_loss, self.val_acc = [], []
@@ -47,71 +72,82 @@ class SegNet:
         self.saver = None
         self.images_tr, self.labels_tr = None, None
         self.images_val, self.labels_val = None, None
+        self.handle_tr, self.handle_val = None, None
+        self.step_times = []
         self.graph = tf.Graph()
 
-        with self.graph.as_default():
+        with self.graph.as_default(), tf.device(self.device):
             self.sess = tf.Session()
             self.is_training_pl = tf.placeholder(tf.bool, name="is_training")
             self.with_dropout_pl = tf.placeholder(tf.bool, name="with_dropout")
             self.keep_prob_pl = tf.placeholder(tf.float32, shape=None, name="keep_rate")
-            self.inputs_pl = tf.placeholder(tf.float32, [self.batch_size, self.input_h, self.input_w, self.input_c])
-            self.labels_pl = tf.placeholder(tf.int64, [self.batch_size, self.input_h, self.input_w, 1])
+            # The inputs can be fed as numpy arrays through inputs_pl/labels_pl, or, when nothing is fed there,
+            # they are pulled straight from a tf.data pipeline inside the graph. input_handle_pl selects the
+            # pipeline (train or val), see train with INPUT_MODE "direct".
+            # Only the number of channels is fixed: any batch size and any height and width (odd ones included)
+            # can be fed, INPUT_HEIGHT/INPUT_WIDTH are only the size of the training images.
+            self.input_handle_pl = tf.placeholder(tf.string, shape=[], name="input_handle")
+            input_iterator = tf.data.Iterator.from_string_handle(
+                self.input_handle_pl, (tf.float32, tf.uint8),
+                (tf.TensorShape([None, None, None, self.input_c]), tf.TensorShape([None, None, None, 1])))
+            images_it, labels_it = input_iterator.get_next()
+            self.inputs_pl = tf.placeholder_with_default(images_it, [None, None, None, self.input_c])
+            self.labels_pl = tf.placeholder_with_default(tf.to_int64(labels_it), [None, None, None, 1])
+            # Display the training images in the visualizer.
+            tf.summary.image('training_images', self.inputs_pl)
 
             # Before enter the images into the architecture, we need to do Local Contrast Normalization
             # But it seems a bit complicated, so we use Local Response Normalization which implement in Tensorflow
             # Reference page:https://www.tensorflow.org/api_docs/python/tf/nn/local_response_normalization
             self.norm1 = tf.nn.lrn(self.inputs_pl, depth_radius=5, bias=1.0, alpha=0.0001, beta=0.75, name='norm1')
+            # PRECISION "float16"/"bfloat16": the encoder and decoder compute in lower precision from here on (see
+            # conv_layer), the classifier and the loss are in float32 again
+            self.norm1 = tf.cast(self.norm1, self.compute_dtype)
+            self.dropout_rate = tf.cast(1 - self.keep_prob_pl, self.compute_dtype)
+            # Every box of convolution layers is a conv_block, the boxes listed in RECOMPUTE_BLOCKS ("conv1" ..
+            # "conv5", "deconv5" .. "deconv1") do not keep their inner activations for the backward pass, they are
+            # recomputed instead (gradient checkpointing)
             # first box of convolution layer,each part we do convolution two times, so we have conv1_1, and conv1_2
-            self.conv1_1 = conv_layer(self.norm1, "conv1_1", [3, 3, 3, 64], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv1_2 = conv_layer(self.conv1_1, "conv1_2", [3, 3, 64, 64], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
+            self.conv1_1, self.conv1_2 = self.conv_block(self.norm1, "conv1", [("conv1_1", [3, 3, 3, 64]),
+                                                                               ("conv1_2", [3, 3, 64, 64])], True)
             self.pool1, self.pool1_index, self.shape_1 = max_pool(self.conv1_2, 'pool1')
 
             # Second box of convolution layer(4)
-            self.conv2_1 = conv_layer(self.pool1, "conv2_1", [3, 3, 64, 128], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv2_2 = conv_layer(self.conv2_1, "conv2_2", [3, 3, 128, 128], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
+            self.conv2_1, self.conv2_2 = self.conv_block(self.pool1, "conv2", [("conv2_1", [3, 3, 64, 128]),
+                                                                               ("conv2_2", [3, 3, 128, 128])], True)
             self.pool2, self.pool2_index, self.shape_2 = max_pool(self.conv2_2, 'pool2')
 
             # Third box of convolution layer(7)
-            self.conv3_1 = conv_layer(self.pool2, "conv3_1", [3, 3, 128, 256], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv3_2 = conv_layer(self.conv3_1, "conv3_2", [3, 3, 256, 256], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv3_3 = conv_layer(self.conv3_2, "conv3_3", [3, 3, 256, 256], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
+            self.conv3_1, self.conv3_2, self.conv3_3 = self.conv_block(self.pool2, "conv3",
+                                                                       [("conv3_1", [3, 3, 128, 256]),
+                                                                        ("conv3_2", [3, 3, 256, 256]),
+                                                                        ("conv3_3", [3, 3, 256, 256])], True)
             self.pool3, self.pool3_index, self.shape_3 = max_pool(self.conv3_3, 'pool3')
 
             # Fourth box of convolution layer(10)
             if self.bayes:
-                self.dropout1 = tf.layers.dropout(self.pool3, rate=(1 - self.keep_prob_pl),
+                self.dropout1 = tf.layers.dropout(self.pool3, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout1")
-                self.conv4_1 = conv_layer(self.dropout1, "conv4_1", [3, 3, 256, 512], self.is_training_pl, self.use_vgg,
-                                          self.vgg_param_dict)
+                block_input = self.dropout1
             else:
-                self.conv4_1 = conv_layer(self.pool3, "conv4_1", [3, 3, 256, 512], self.is_training_pl, self.use_vgg,
-                                          self.vgg_param_dict)
-            self.conv4_2 = conv_layer(self.conv4_1, "conv4_2", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv4_3 = conv_layer(self.conv4_2, "conv4_3", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
+                block_input = self.pool3
+            self.conv4_1, self.conv4_2, self.conv4_3 = self.conv_block(block_input, "conv4",
+                                                                       [("conv4_1", [3, 3, 256, 512]),
+                                                                        ("conv4_2", [3, 3, 512, 512]),
+                                                                        ("conv4_3", [3, 3, 512, 512])], True)
             self.pool4, self.pool4_index, self.shape_4 = max_pool(self.conv4_3, 'pool4')
 
             # Fifth box of convolution layers(13)
             if self.bayes:
-                self.dropout2 = tf.layers.dropout(self.pool4, rate=(1 - self.keep_prob_pl),
+                self.dropout2 = tf.layers.dropout(self.pool4, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout2")
-                self.conv5_1 = conv_layer(self.dropout2, "conv5_1", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                          self.vgg_param_dict)
+                block_input = self.dropout2
             else:
-                self.conv5_1 = conv_layer(self.pool4, "conv5_1", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                          self.vgg_param_dict)
-            self.conv5_2 = conv_layer(self.conv5_1, "conv5_2", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
-            self.conv5_3 = conv_layer(self.conv5_2, "conv5_3", [3, 3, 512, 512], self.is_training_pl, self.use_vgg,
-                                      self.vgg_param_dict)
+                block_input = self.pool4
+            self.conv5_1, self.conv5_2, self.conv5_3 = self.conv_block(block_input, "conv5",
+                                                                       [("conv5_1", [3, 3, 512, 512]),
+                                                                        ("conv5_2", [3, 3, 512, 512]),
+                                                                        ("conv5_3", [3, 3, 512, 512])], True)
             self.pool5, self.pool5_index, self.shape_5 = max_pool(self.conv5_3, 'pool5')
 
             # ---------------------So Now the encoder process has been Finished--------------------------------------#
@@ -119,55 +155,70 @@ class SegNet:
 
             # First box of deconvolution layers(3)
             if self.bayes:
-                self.dropout3 = tf.layers.dropout(self.pool5, rate=(1 - self.keep_prob_pl),
+                self.dropout3 = tf.layers.dropout(self.pool5, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout3")
-                self.deconv5_1 = up_sampling(self.dropout3, self.pool5_index, self.shape_5, name="unpool_5")
+                self.deconv5_1 = up_sampling(self.dropout3, self.pool5_index, self.shape_5, name="unpool_5",
+                                             mode=self.unpool_mode)
             else:
-                self.deconv5_1 = up_sampling(self.pool5, self.pool5_index, self.shape_5, name="unpool_5")
-            self.deconv5_2 = conv_layer(self.deconv5_1, "deconv5_2", [3, 3, 512, 512], self.is_training_pl)
-            self.deconv5_3 = conv_layer(self.deconv5_2, "deconv5_3", [3, 3, 512, 512], self.is_training_pl)
-            self.deconv5_4 = conv_layer(self.deconv5_3, "deconv5_4", [3, 3, 512, 512], self.is_training_pl)
+                self.deconv5_1 = up_sampling(self.pool5, self.pool5_index, self.shape_5, name="unpool_5",
+                                             mode=self.unpool_mode)
+            self.deconv5_2, self.deconv5_3, self.deconv5_4 = self.conv_block(self.deconv5_1, "deconv5",
+                                                                             [("deconv5_2", [3, 3, 512, 512]),
+                                                                              ("deconv5_3", [3, 3, 512, 512]),
+                                                                              ("deconv5_4", [3, 3, 512, 512])])
             # Second box of deconvolution layers(6)
             if self.bayes:
-                self.dropout4 = tf.layers.dropout(self.deconv5_4, rate=(1 - self.keep_prob_pl),
+                self.dropout4 = tf.layers.dropout(self.deconv5_4, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout4")
-                self.deconv4_1 = up_sampling(self.dropout4, self.pool4_index, self.shape_4, name="unpool_4")
+                self.deconv4_1 = up_sampling(self.dropout4, self.pool4_index, self.shape_4, name="unpool_4",
+                                             mode=self.unpool_mode)
             else:
-                self.deconv4_1 = up_sampling(self.deconv5_4, self.pool4_index, self.shape_4, name="unpool_4")
-            self.deconv4_2 = conv_layer(self.deconv4_1, "deconv4_2", [3, 3, 512, 512], self.is_training_pl)
-            self.deconv4_3 = conv_layer(self.deconv4_2, "deconv4_3", [3, 3, 512, 512], self.is_training_pl)
-            self.deconv4_4 = conv_layer(self.deconv4_3, "deconv4_4", [3, 3, 512, 256], self.is_training_pl)
+                self.deconv4_1 = up_sampling(self.deconv5_4, self.pool4_index, self.shape_4, name="unpool_4",
+                                             mode=self.unpool_mode)
+            self.deconv4_2, self.deconv4_3, self.deconv4_4 = self.conv_block(self.deconv4_1, "deconv4",
+                                                                             [("deconv4_2", [3, 3, 512, 512]),
+                                                                              ("deconv4_3", [3, 3, 512, 512]),
+                                                                              ("deconv4_4", [3, 3, 512, 256])])
             # Third box of deconvolution layers(9)
             if self.bayes:
-                self.dropout5 = tf.layers.dropout(self.deconv4_4, rate=(1 - self.keep_prob_pl),
+                self.dropout5 = tf.layers.dropout(self.deconv4_4, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout5")
-                self.deconv3_1 = up_sampling(self.dropout5, self.pool3_index, self.shape_3, name="unpool_3")
+                self.deconv3_1 = up_sampling(self.dropout5, self.pool3_index, self.shape_3, name="unpool_3",
+                                             mode=self.unpool_mode)
             else:
-                self.deconv3_1 = up_sampling(self.deconv4_4, self.pool3_index, self.shape_3, name="unpool_3")
-            self.deconv3_2 = conv_layer(self.deconv3_1, "deconv3_2", [3, 3, 256, 256], self.is_training_pl)
-            self.deconv3_3 = conv_layer(self.deconv3_2, "deconv3_3", [3, 3, 256, 256], self.is_training_pl)
-            self.deconv3_4 = conv_layer(self.deconv3_3, "deconv3_4", [3, 3, 256, 128], self.is_training_pl)
+                self.deconv3_1 = up_sampling(self.deconv4_4, self.pool3_index, self.shape_3, name="unpool_3",
+                                             mode=self.unpool_mode)
+            self.deconv3_2, self.deconv3_3, self.deconv3_4 = self.conv_block(self.deconv3_1, "deconv3",
+                                                                             [("deconv3_2", [3, 3, 256, 256]),
+                                                                              ("deconv3_3", [3, 3, 256, 256]),
+                                                                              ("deconv3_4", [3, 3, 256, 128])])
             # Fourth box of deconvolution layers(11)
             if self.bayes:
-                self.dropout6 = tf.layers.dropout(self.deconv3_4, rate=(1 - self.keep_prob_pl),
+                self.dropout6 = tf.layers.dropout(self.deconv3_4, rate=self.dropout_rate,
                                                   training=self.with_dropout_pl, name="dropout6")
-                self.deconv2_1 = up_sampling(self.dropout6, self.pool2_index, self.shape_2, name="unpool_2")
+                self.deconv2_1 = up_sampling(self.dropout6, self.pool2_index, self.shape_2, name="unpool_2",
+                                             mode=self.unpool_mode)
             else:
-                self.deconv2_1 = up_sampling(self.deconv3_4, self.pool2_index, self.shape_2, name="unpool_2")
-            self.deconv2_2 = conv_layer(self.deconv2_1, "deconv2_2", [3, 3, 128, 128], self.is_training_pl)
-            self.deconv2_3 = conv_layer(self.deconv2_2, "deconv2_3", [3, 3, 128, 64], self.is_training_pl)
+                self.deconv2_1 = up_sampling(self.deconv3_4, self.pool2_index, self.shape_2, name="unpool_2",
+                                             mode=self.unpool_mode)
+            self.deconv2_2, self.deconv2_3 = self.conv_block(self.deconv2_1, "deconv2",
+                                                             [("deconv2_2", [3, 3, 128, 128]),
+                                                              ("deconv2_3", [3, 3, 128, 64])])
             # Fifth box of deconvolution layers(13)
-            self.deconv1_1 = up_sampling(self.deconv2_3, self.pool1_index, self.shape_1, name="unpool_1")
-            self.deconv1_2 = conv_layer(self.deconv1_1, "deconv1_2", [3, 3, 64, 64], self.is_training_pl)
-            self.deconv1_3 = conv_layer(self.deconv1_2, "deconv1_3", [3, 3, 64, 64], self.is_training_pl)
+            self.deconv1_1 = up_sampling(self.deconv2_3, self.pool1_index, self.shape_1, name="unpool_1",
+                                         mode=self.unpool_mode)
+            self.deconv1_2, self.deconv1_3 = self.conv_block(self.deconv1_1, "deconv1",
+                                                             [("deconv1_2", [3, 3, 64, 64]),
+                                                              ("deconv1_3", [3, 3, 64, 64])])
 
             with tf.variable_scope('conv_classifier') as scope:
                 self.kernel = variable_with_weight_decay('weights', initializer=initialization(1, 64),
                                                          shape=[1, 1, 64, self.num_classes], wd=False)
-                self.conv = tf.nn.conv2d(self.deconv1_3, self.kernel, [1, 1, 1, 1], padding='SAME')
+                self.conv = tf.nn.conv2d(tf.to_float(self.deconv1_3), self.kernel, [1, 1, 1, 1], padding='SAME')
                 self.biases = variable_with_weight_decay('biases', tf.constant_initializer(0.0),
                                                          shape=[self.num_classes], wd=False)
                 self.logits = tf.nn.bias_add(self.conv, self.biases, name=scope.name)
+            self.prob = tf.nn.softmax(self.logits, dim=-1)
 
     def retrain(self, max_steps=30001, batch_size=3):
         self.sess = tf.Session()
@@ -182,72 +233,137 @@ class SegNet:
         image_filename, label_filename = get_filename_list(self.test_file, self.config)
         val_image_filename, val_label_filename = get_filename_list(self.val_file, self.config)
 
+        # "feed_dict": every batch is fetched to numpy and fed back into inputs_pl/labels_pl
+        # "direct": the graph reads the batches from the tf.data pipeline, they never leave the runtime
+        direct_input = self.config.get("INPUT_MODE", "feed_dict") == "direct"
+        metrics_interval = self.config.get("METRICS_INTERVAL", 100)
+        summary_intervals = {"scalar": 100, "histogram": 100, "image": 100}
+        summary_intervals.update(self.config.get("SUMMARY_INTERVALS", {}))
+        # ACCUM_STEPS > 1: every step sums the gradients of ACCUM_STEPS batches before one optimizer update
+        accum_steps = self.config.get("ACCUM_STEPS", 1)
+
         with self.graph.as_default():
-            if self.images_tr is None:
+            if direct_input and self.handle_tr is None:
+                if self.config.get("CACHE_DIR"):
+                    train_dataset = make_packed_dataset(self.test_file, batch_size, self.config)
+                    val_dataset = make_packed_dataset(self.val_file, batch_size, self.config)
+                else:
+                    train_dataset = make_dataset(image_filename, label_filename, batch_size, self.config)
+                    val_dataset = make_dataset(val_image_filename, val_label_filename, batch_size, self.config)
+                self.handle_tr = train_dataset.make_one_shot_iterator().string_handle()
+                self.handle_val = val_dataset.make_one_shot_iterator().string_handle()
+            elif not direct_input and self.images_tr is None and self.config.get("CACHE_DIR"):
+                # pre-decoded, memory-mapped copy of the data set, see inputs_object.pack_dataset
+                self.images_tr, self.labels_tr = packed_dataset_inputs(self.test_file, batch_size, self.config)
+                self.images_val, self.labels_val = packed_dataset_inputs(self.val_file, batch_size, self.config)
+            elif not direct_input and self.images_tr is None:
                 self.images_tr, self.labels_tr = dataset_inputs(image_filename, label_filename, batch_size, self.config)
                 self.images_val, self.labels_val = dataset_inputs(val_image_filename, val_label_filename, batch_size,
                                                                   self.config)
 
             loss, accuracy, prediction = normal_loss(logits=self.logits, labels=self.labels_pl,
                                                      number_class=self.num_classes)
-            train, global_step = train_op(total_loss=loss, opt=self.opt)
+            if accum_steps > 1:
+                # train only sums the gradients of a micro-batch, apply_gradients updates the weights
+                train, apply_gradients, global_step = accumulating_train_op(
+                    total_loss=loss, opt=self.opt, accum_steps=accum_steps,
+                    loss_scale=self.config.get("LOSS_SCALE", 1.0))
+            else:
+                train, global_step = train_op(total_loss=loss, opt=self.opt,
+                                              loss_scale=self.config.get("LOSS_SCALE", 1.0))
+            train_hist = confusion_matrix(self.labels_pl, prediction, self.num_classes)
+            val_hist, val_hist_update, val_hist_reset = streaming_confusion_matrix(self.labels_pl, prediction,
+                                                                                 self.num_classes)
 
-            summary_op = tf.summary.merge_all()
+            summary_ops = merged_summaries_by_type()
             self.saver = tf.train.Saver(tf.global_variables())
 
             with self.sess.as_default():
                 self.sess.run(tf.local_variables_initializer())
                 self.sess.run(tf.global_variables_initializer())
 
-                coord = tf.train.Coordinator()
-                threads = tf.train.start_queue_runners(coord=coord)
-                # The queue runners basic reference:
-                # https://www.tensorflow.org/versions/r0.12/how_tos/threading_and_queues
+                if direct_input:
+                    train_handle, val_handle = self.sess.run([self.handle_tr, self.handle_val])
+
                 train_writer = tf.summary.FileWriter(self.tb_logs, self.sess.graph)
+                self.step_times = []
+                summary_steps = []
+                metrics_steps = []
+
+                def train_feed_dict():
+                    if direct_input:
+                        feed_dict = {self.input_handle_pl: train_handle}
+                    else:
+                        image_batch, label_batch = self.sess.run([self.images_tr, self.labels_tr])
+                        feed_dict = {self.inputs_pl: image_batch,
+                                     self.labels_pl: label_batch}
+                    feed_dict.update({self.is_training_pl: True,
+                                      self.keep_prob_pl: 0.5,
+                                      self.with_dropout_pl: True})
+                    return feed_dict
+
                 for step in range(max_steps):
-                    image_batch, label_batch = self.sess.run([self.images_tr, self.labels_tr])
-                    feed_dict = {self.inputs_pl: image_batch,
-                                 self.labels_pl: label_batch,
-                                 self.is_training_pl: True,
-                                 self.keep_prob_pl: 0.5,
-                                 self.with_dropout_pl: True}
-
-                    _, _loss, _accuracy, summary = self.sess.run([train, loss, accuracy, summary_op],
-                                                                 feed_dict=feed_dict)
+                    start_time = time.time()
+                    for micro_step in range(accum_steps - 1):
+                        self.sess.run(train, feed_dict=train_feed_dict())
+                    feed_dict = train_feed_dict()
+
+                    # the per class hit counts of the metrics steps come out of the training step itself as a
+                    # [num_classes, num_classes] confusion matrix, no second forward pass and no logits to fetch
+                    fetches = [train, loss, accuracy]
+                    if step % metrics_interval == 0:
+                        fetches += [train_hist]
+                    # every kind of summary is only computed on the steps it is written
+                    summary_due = [summary_ops[kind] for kind in sorted(summary_ops)
+                                   if step % summary_intervals[kind] == 0]
+                    fetched = self.sess.run(fetches + summary_due, feed_dict=feed_dict)
+                    if accum_steps > 1:
+                        self.sess.run(apply_gradients)
+                    self.step_times.append(time.time() - start_time)
+                    summary_steps.append(len(summary_due) > 0)
+                    metrics_steps.append(step % metrics_interval == 0)
+                    _, _loss, _accuracy = fetched[:3]
                     self.train_loss.append(_loss)
                     self.train_accuracy.append(_accuracy)
                     print("Iteration {}: Train Loss{:6.3f}, Train Accu {:6.3f}".format(step, self.train_loss[-1],
                                                                                        self.train_accuracy[-1]))
 
-                    if step % 100 == 0:
-                        conv_classifier = self.sess.run(self.logits, feed_dict=feed_dict)
-                        print('per_class accuracy by logits in training time',
-                              per_class_acc(conv_classifier, label_batch, self.num_classes))
-                        # per_class_acc is a function from utils
+                    if step % metrics_interval == 0:
+                        print('per_class accuracy by logits in training time')
+                        print_hist_summary(fetched[3])
+
+                    for summary in fetched[len(fetches):]:
                         train_writer.add_summary(summary, step)
 
+                    if step % metrics_interval == 0:
+                        print("Mean step time ({} input): {:.4f} s".format(
+                            "direct" if direct_input else "feed_dict", np.mean(self.step_times[-metrics_interval:])))
+
                     if step % 1000 == 0:
                         print("start validating.......")
                         _val_loss = []
                         _val_acc = []
-                        hist = np.zeros((self.num_classes, self.num_classes))
+                        self.sess.run(val_hist_reset)
                         for test_step in range(int(20)):
-                            fetches_valid = [loss, accuracy, self.logits]
-                            image_batch_val, label_batch_val = self.sess.run([self.images_val, self.labels_val])
-                            feed_dict_valid = {self.inputs_pl: image_batch_val,
-                                               self.labels_pl: label_batch_val,
-                                               self.is_training_pl: True,
-                                               self.keep_prob_pl: 1.0,
-                                               self.with_dropout_pl: False}
+                            # the confusion matrix is accumulated in the graph, the logits stay there
+                            fetches_valid = [loss, accuracy, val_hist_update]
+                            if direct_input:
+                                feed_dict_valid = {self.input_handle_pl: val_handle}
+                            else:
+                                image_batch_val, label_batch_val = self.sess.run([self.images_val, self.labels_val])
+                                feed_dict_valid = {self.inputs_pl: image_batch_val,
+                                                   self.labels_pl: label_batch_val}
+                            feed_dict_valid.update({self.is_training_pl: True,
+                                                    self.keep_prob_pl: 1.0,
+                                                    self.with_dropout_pl: False})
                             # since we still using mini-batch, so in the batch norm we set phase_train to be
                             # true, and because we didin't run the trainop process, so it will not update
                             # the weight!
-                            _loss, _acc, _val_pred = self.sess.run(fetches_valid, feed_dict_valid)
+                            _loss, _acc, _ = self.sess.run(fetches_valid, feed_dict_valid)
                             _val_loss.append(_loss)
                             _val_acc.append(_acc)
-                            hist += get_hist(_val_pred, label_batch_val)
 
-                        print_hist_summary(hist)
+                        print_hist_summary(self.sess.run(val_hist))
 
                         self.val_loss.append(np.mean(_val_loss))
                         self.val_acc.append(np.mean(_val_acc))
@@ -257,8 +373,13 @@ class SegNet:
                                 step, self.train_loss[-1], self.train_accuracy[-1], self.val_loss[-1],
                                 self.val_acc[-1]))
 
-                coord.request_stop()
-                coord.join(threads)
+                print_step_overhead(self.step_times, summary_steps, "Summary")
+                # only the metrics steps without summaries show the cost of the metrics alone (with the default
+                # intervals every metrics step is a summary step as well), compared with the ordinary steps which
+                # have neither
+                metrics_only_steps = np.array(metrics_steps) & ~np.array(summary_steps)
+                print_step_overhead(self.step_times, metrics_only_steps, "Metrics", exclude_steps=summary_steps)
+
     
     
     def visual_results(self, dataset_type = "TRAIN", NUM_IMAGES = 3):
@@ -281,7 +402,6 @@ class SegNet:
             _, _, prediction = normal_loss(logits=self.logits, 
                                            labels=self.labels_pl,
                                            number_class=self.num_classes)
-            prob = tf.nn.softmax(self.logits,dim = -1)
             
             if (dataset_type=='TRAIN'):
                 test_type_path = self.config["TRAIN_FILE"]
@@ -304,7 +424,7 @@ class SegNet:
             images = [images[i] for i in indexes[0:NUM_IMAGES]]
             labels = [labels[i] for i in indexes[0:NUM_IMAGES]]
             
-            num_sample_generate = 30
+            num_sample_generate = self.config.get("MC_SAMPLES", 30)
             pred_tot = []
             var_tot = []
             
@@ -323,36 +443,274 @@ class SegNet:
                     pred = np.reshape(pred,[image_h,image_w])
                     var_one = []
                 else:
-                    feed_dict = {self.inputs_pl: image_batch, 
-                                 self.labels_pl: label_batch, 
-                                 self.is_training_pl: False, 
-                                 self.keep_prob_pl: 0.5,
-                                 self.with_dropout_pl: False}
-                    prob_iter_tot = []
-                    for iter_step in range(num_sample_generate):
-                        prob_iter_step = sess.run(fetches = [prob], feed_dict = feed_dict) 
-                        prob_iter_tot.append(prob_iter_step)
-
-                    prob_mean = np.nanmean(prob_iter_tot,axis = 0)
-                    prob_variance = np.var(prob_iter_tot, axis = 0)
+                    prob_moments = self.mc_dropout_samples(image_batch[0], num_sample_generate,
+                                                           tolerance=self.config.get("MC_TOLERANCE", None))
 
                     #THIS TIME I DIDN'T INCLUDE TAU
-                    pred = np.reshape(np.argmax(prob_mean,axis = -1),[-1]) #pred is the predicted label
-
-                    var_sep = [] #var_sep is the corresponding variance if this pixel choose label k
-                    length_cur = 0 #length_cur represent how many pixels has been read for one images
-                    for row in np.reshape(prob_variance,[image_h*image_w,12]):
-                        temp = row[pred[length_cur]]
-                        length_cur += 1
-                        var_sep.append(temp)
-                    var_one = np.reshape(var_sep,[image_h,image_w]) #var_one is the corresponding variance in terms of the "optimal" label
-                    pred = np.reshape(pred,[image_h,image_w])
+                    #pred is the predicted label, var_one is the corresponding variance in terms of the "optimal" label
+                    pred, var_one, entropy, mutual_info = prob_moments.uncertainty_maps()
 
                 pred_tot.append(pred)
                 var_tot.append(var_one)
             
             draw_plots(images, labels, pred_tot)
 
+    def conv_block(self, bottom, block_name, layer_params, encoder=False):
+        """
+        A box of conv_layer, layer_params is the list of (layer name, kernel shape). The encoder boxes can be
+        initialized from VGG. Output: the output of every layer of the box.
+        """
+        vgg_param_dict = self.vgg_param_dict if encoder else None
+        use_vgg = self.use_vgg if encoder else False
+        return conv_block(bottom, layer_params, self.is_training_pl, use_vgg, vgg_param_dict,
+                          recompute=block_name in self.recompute_blocks)
+
+    def activation_bytes(self):
+        """
+        Memory taken by the layer outputs of one forward pass (conv, pooling values and indices, unpooling) of a
+        BATCH_SIZE batch of INPUT_HEIGHT x INPUT_WIDTH images, the number to compare between the PRECISION modes.
+        The graph has no static shapes, so they are computed by running it once on zeros in a separate session.
+        """
+        activations = [tensor for name, tensor in vars(self).items()
+                       if isinstance(tensor, tf.Tensor) and name.startswith(("conv", "pool", "deconv", "dropout"))]
+        with self.graph.as_default():
+            shapes = [tf.shape(tensor) for tensor in activations]
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                shapes = sess.run(shapes, feed_dict={
+                    self.inputs_pl: np.zeros([self.batch_size, self.input_h, self.input_w, self.input_c]),
+                    self.is_training_pl: False,
+                    self.keep_prob_pl: 1.0,
+                    self.with_dropout_pl: False})
+        total_bytes = 0
+        for tensor, shape in zip(activations, shapes):
+            total_bytes += np.prod(shape) * tensor.dtype.size
+        print("Activation memory ({}): {:.1f} MB".format(self.compute_dtype.name, total_bytes / 2.0 ** 20))
+        return total_bytes
+
+    def restore(self, checkpoint=None):
+        """
+        Restore the weights from checkpoint, SAVE_MODEL_DIR by default.
+        """
+        with self.graph.as_default():
+            saver = tf.train.Saver()
+            saver.restore(self.sess, checkpoint or self.config["SAVE_MODEL_DIR"])
+
+    def test(self, checkpoint=None):
+        """
+        Evaluate the images of TEST_FILE in batches of BATCH_SIZE, the confusion matrix is accumulated batch by batch
+        inside the graph. The graph has no fixed batch size, so the last, smaller batch is run as it is.
+        Output: global accuracy and the IU of every class
+        """
+        image_filename, label_filename = get_filename_list(self.config["TEST_FILE"], self.config)
+        with self.graph.as_default():
+            dataset = make_dataset(image_filename, label_filename, self.batch_size, self.config, shuffle=False,
+                                   repeat=False)
+            # the batches are pulled from the dataset inside the graph (see INPUT_MODE "direct" in train), they are
+            # never copied out to numpy and fed back
+            test_handle = dataset.make_one_shot_iterator().string_handle()
+            hist, hist_update, hist_reset = streaming_confusion_matrix(self.labels_pl, tf.argmax(self.logits, axis=-1),
+                                                                       self.num_classes, name='test_confusion_matrix')
+            batch_images = tf.shape(self.inputs_pl)[0]
+        self.restore(checkpoint)
+
+        self.sess.run(hist_reset)
+        feed_dict = {self.input_handle_pl: self.sess.run(test_handle),
+                     self.is_training_pl: False,
+                     self.keep_prob_pl: 1.0,
+                     self.with_dropout_pl: False}
+        num_images = 0
+        start_time = time.time()
+        while True:
+            try:
+                _, num_batch_images = self.sess.run([hist_update, batch_images], feed_dict=feed_dict)
+            except tf.errors.OutOfRangeError:
+                break
+            num_images += num_batch_images
+        hist = self.sess.run(hist)
+        duration = time.time() - start_time
+
+        print("Tested {} images in {:.1f} s, {:.2f} images/sec".format(num_images, duration, num_images / duration))
+        print_hist_summary(hist)
+        acc_total, _, iu = hist_metrics(hist)
+        return acc_total, iu
+
+    def mc_dropout_samples(self, image, num_samples=30, keep_prob=0.5, tolerance=None):
+        """
+        Monte Carlo dropout samples of the softmax output for one image, accumulated in a RunningMoments (mean,
+        variance and mean entropy), so the memory does not grow with num_samples.
+        The encoder up to pool3 has no dropout, so it is run once and its output (and the pooling indices the
+        decoder needs) is fed back in for the sampling runs. The prefix runs on the single image, and its outputs
+        are repeated MC_BATCH_SIZE times (10 by default) afterwards (the argmax indices are per image, so they can
+        be repeated as well), so every sampling run produces MC_BATCH_SIZE samples at once.
+        The image can have any height and width.
+        If tolerance is given, the sampling stops early once the per-pixel variance of the predicted class changes
+        less than tolerance between two runs.
+        """
+        # the unpooling output shapes of the first three boxes come from the encoder as well
+        prefix = [self.pool3, self.pool1_index, self.pool2_index, self.pool3_index,
+                  self.shape_1, self.shape_2, self.shape_3]
+        sample_batch_size = min(self.mc_batch_size, num_samples)
+        prefix_value = self.sess.run(prefix, feed_dict={
+            self.inputs_pl: np.reshape(image, (1,) + np.shape(image)[:2] + (self.input_c,)),
+            self.is_training_pl: False})
+        activations, shapes = prefix_value[:4], prefix_value[4:]
+        activations = [np.repeat(value, sample_batch_size, axis=0) for value in activations]
+        # the unpooling shapes carry the batch size as well
+        shapes = [np.concatenate([[sample_batch_size], shape[1:]]).astype(shape.dtype) for shape in shapes]
+
+        feed_dict = dict(zip(prefix, activations + shapes))
+        feed_dict.update({self.is_training_pl: False,
+                          self.keep_prob_pl: keep_prob,
+                          self.with_dropout_pl: True})
+        moments = RunningMoments()
+        while moments.count < num_samples:
+            prob_batch = self.sess.run(self.prob, feed_dict=feed_dict)
+            moments.update(prob_batch[:num_samples - moments.count])
+            if tolerance is not None and moments.converged(tolerance):
+                break
+        return moments
+
+    def predict_tiled(self, image, tile_size=None, overlap=None, tile_batch_size=None, blend=None):
+        """
+        Logits of an image of any size, [height, width, num_classes], computed on overlapping tiles of tile_size
+        ((height, width), INPUT_HEIGHT x INPUT_WIDTH by default). The tiles are run tile_batch_size at a time
+        (TILE_BATCH_SIZE), so the memory of the graph depends on the tile batch and not on the image size.
+        The logits of the tiles are averaged with the weights of tiling_object.blend_weights, TILE_BLEND
+        ("linear" or "uniform"), where neighbouring tiles overlap by TILE_OVERLAP pixels.
+        """
+        tile_h, tile_w = tile_size or (self.input_h, self.input_w)
+        overlap = self.config.get("TILE_OVERLAP", 64) if overlap is None else overlap
+        tile_batch_size = tile_batch_size or self.config.get("TILE_BATCH_SIZE", self.batch_size)
+        blend = blend or self.config.get("TILE_BLEND", "linear")
+
+        image_h, image_w = np.shape(image)[:2]
+        tile_h, tile_w = min(tile_h, image_h), min(tile_w, image_w)
+        positions = tile_positions(image_h, image_w, tile_h, tile_w, overlap)
+        weights = blend_weights(tile_h, tile_w, overlap, blend)
+        logits_sum = np.zeros([image_h, image_w, self.num_classes], dtype=np.float32)
+        weight_sum = np.zeros([image_h, image_w, 1], dtype=np.float32)
+        feed_dict = {self.is_training_pl: False,
+                     self.keep_prob_pl: 1.0,
+                     self.with_dropout_pl: False}
+        for i in range(0, len(positions), tile_batch_size):
+            batch_positions = positions[i:i + tile_batch_size]
+            feed_dict[self.inputs_pl] = np.stack([image[y:y + tile_h, x:x + tile_w] for y, x in batch_positions])
+            logits_batch = self.sess.run(self.logits, feed_dict=feed_dict)
+            for (y, x), logits in zip(batch_positions, logits_batch):
+                logits_sum[y:y + tile_h, x:x + tile_w] += logits * weights[:, :, np.newaxis]
+                weight_sum[y:y + tile_h, x:x + tile_w] += weights[:, :, np.newaxis]
+        return logits_sum / weight_sum
+
+    def predict_stream(self, paths, batch_size=None, decode_workers=4, post_workers=2, queue_size=16,
+                       postprocess=None, read=None):
+        """
+        Pipelined prediction of the images in paths (any iterable, it is read lazily). Three stages run at the
+        same time: decoding on a pool of decode_workers threads, the model on batches of batch_size (BATCH_SIZE)
+        consecutive images of the same size, and postprocess(prob) on a pool of post_workers threads. The stages
+        are connected by queues of at most queue_size items, so the memory stays bounded for any number of paths.
+        postprocess gets the softmax output [height, width, num_classes], the default returns the label map and
+        its colour image (drawings_object.colour_image, with the colours of PALETTE).
+        read(path) decodes one item of paths to an image [height, width, channels], by default paths are image
+        files, but they can be anything read understands (e.g. video frames).
+        Yields (path, postprocess output) in the order of paths.
+        """
+        batch_size = batch_size or self.batch_size
+        postprocess = postprocess or (lambda prob: _labels_and_colours(prob, self.config.get("PALETTE")))
+        read = read or read_image
+        decoded = queue.Queue(maxsize=queue_size)
+        results = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        decode_pool = ThreadPoolExecutor(max_workers=decode_workers)
+        post_pool = ThreadPoolExecutor(max_workers=post_workers)
+
+        # put and get give up once stop is set (the caller stopped reading the generator), so no thread is left
+        # blocked on a full or an empty queue
+        def put(target, item):
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(source):
+            while not stop.is_set():
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def read_paths():
+            try:
+                for path in paths:
+                    if not put(decoded, (path, decode_pool.submit(read, path))):
+                        return
+            except Exception as e:
+                # iterating paths failed (e.g. a video which can not be read), run_model raises it from the failed
+                # future and hands it over to the caller
+                failed = Future()
+                failed.set_exception(e)
+                put(decoded, (None, failed))
+            put(decoded, None)
+
+        def run_batch(batch, feed_dict):
+            feed_dict[self.inputs_pl] = np.stack([image for _, image in batch])
+            prob_batch = self.sess.run(self.prob, feed_dict=feed_dict)
+            for (path, _), prob in zip(batch, prob_batch):
+                if not put(results, (path, post_pool.submit(postprocess, prob))):
+                    return False
+            return True
+
+        def run_model():
+            feed_dict = {self.is_training_pl: False,
+                         self.keep_prob_pl: 1.0,
+                         self.with_dropout_pl: False}
+            batch = []
+            try:
+                while True:
+                    item = get(decoded)
+                    if item is None:
+                        break
+                    path, image = item[0], item[1].result()
+                    # a batch only holds images of the same size
+                    if batch and image.shape != batch[0][1].shape:
+                        if not run_batch(batch, feed_dict):
+                            return
+                        batch = []
+                    batch.append((path, image))
+                    if len(batch) == batch_size:
+                        if not run_batch(batch, feed_dict):
+                            return
+                        batch = []
+                if batch and not run_batch(batch, feed_dict):
+                    return
+            except Exception as e:
+                # handed over to the caller, the error is raised by the generator
+                failed = Future()
+                failed.set_exception(e)
+                put(results, (None, failed))
+            put(results, None)
+
+        threads = [threading.Thread(target=read_paths), threading.Thread(target=run_model)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                item = get(results)
+                if item is None:
+                    break
+                yield item[0], item[1].result()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            decode_pool.shutdown(wait=False)
+            post_pool.shutdown(wait=False)
+
     def save(self):
         np.save(self.saved_dir + "Data/trainloss", self.train_loss)
         np.save(self.saved_dir + "Data/trainacc", self.train_accuracy)
@@ -361,3 +719,208 @@ class SegNet:
         checkpoint_path = os.path.join(self.saved_dir, 'model.ckpt')
         self.saver.save(self.sess, checkpoint_path, global_step=self.model_version)
         self.model_version += 1
+
+
+def read_image(path):
+    return scipy.misc.imread(path).astype(np.float32)
+
+
+def _labels_and_colours(prob, palette=None):
+    labels = np.argmax(prob, axis=-1)
+    return labels, colour_image(labels, palette)
+
+
+def merged_summaries_by_type():
+    """
+    Split the summaries of the graph into one merged op per kind, "scalar", "histogram" and "image", so every kind
+    can be computed with its own interval (SUMMARY_INTERVALS) instead of merge_all on every step.
+    """
+    op_types = {"scalar": "ScalarSummary", "histogram": "HistogramSummary", "image": "ImageSummary"}
+    summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+    summary_ops = {}
+    for kind, op_type in op_types.items():
+        kind_summaries = [summary for summary in summaries if summary.op.type == op_type]
+        if kind_summaries:
+            summary_ops[kind] = tf.summary.merge(kind_summaries)
+    return summary_ops
+
+
+def print_step_overhead(step_times, marked_steps, kind="Summary", exclude_steps=None):
+    """
+    Compare the mean step time of the marked steps (e.g. the steps that computed summaries or the training metrics)
+    with the other steps (the first step is left out, it includes the graph warm up), and estimate the time saved by
+    not doing the extra work on every step. The steps in exclude_steps are not counted as other steps, e.g. the
+    summary steps when the metrics steps are compared with the ordinary ones.
+    """
+    step_times = np.array(step_times[1:])
+    marked_steps = np.array(marked_steps[1:], dtype=bool)
+    other_steps = ~marked_steps
+    if exclude_steps is not None:
+        other_steps &= ~np.array(exclude_steps[1:], dtype=bool)
+    if not marked_steps.any() or not other_steps.any():
+        print("{} step time: nothing to compare, {} {} steps and {} other steps after the first step".format(
+            kind, np.sum(marked_steps), kind.lower(), np.sum(other_steps)))
+        return
+    overhead = np.mean(step_times[marked_steps]) - np.mean(step_times[other_steps])
+    print("{} steps {:.4f} s, other steps {:.4f} s: {:.4f} s overhead per {} step, {:.1f} s saved "
+          "over {} other steps".format(kind, np.mean(step_times[marked_steps]), np.mean(step_times[other_steps]),
+                                         overhead, kind.lower(), overhead * np.sum(other_steps),
+                                         np.sum(other_steps)))
+
+
+def peak_memory_bytes(sess, fetches, feed_dict):
+    """
+    Run fetches once and return the peak memory of the whole process up to the end of the run. On GPU it is the
+    largest amount the GPU allocator ever had in use (tf.contrib.memory_stats.MaxBytesInUse), on CPU the largest
+    resident set size of the process (resource.getrusage ru_maxrss), which also counts the weights, the graph and
+    the Python interpreter. Both are maxima over the lifetime of the process, so the configurations to compare
+    have to run in separate processes, see training_step_peak_memory.
+    """
+    sess.run(fetches, feed_dict=feed_dict)
+    if tf.test.is_gpu_available():
+        with sess.graph.as_default():
+            return int(sess.run(tf.contrib.memory_stats.MaxBytesInUse()))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def compare_recompute_memory(conf_file="config.json", batch_sizes=(1, 2, 3, 4, 6, 8),
+                             recompute_blocks=("conv1", "conv2", "deconv2", "deconv1")):
+    """
+    Peak memory of one training step on random data for every batch size, without and with gradient checkpointing
+    of recompute_blocks, every configuration in its own process (see training_step_peak_memory).
+    """
+    result = {}
+    for batch_size in batch_sizes:
+        for blocks in [[], list(recompute_blocks)]:
+            result[(batch_size, len(blocks) > 0)] = training_step_peak_memory(
+                conf_file, {"BATCH_SIZE": batch_size, "RECOMPUTE_BLOCKS": blocks})
+        print("Batch size {}: peak memory {:.0f} MB, with recompute {:.0f} MB".format(
+            batch_size, result[(batch_size, False)] / 2.0 ** 20, result[(batch_size, True)] / 2.0 ** 20))
+    return result
+
+
+def compare_precision_memory(conf_file="config.json", batch_size=3, precisions=("float32", "float16")):
+    """
+    Peak memory of one training step on random data for every PRECISION, every configuration in its own process
+    (see training_step_peak_memory). The activation memory of SegNet.activation_bytes does not include the
+    temporary tensors (casts, batch norm, gradients).
+    """
+    result = {}
+    for precision in precisions:
+        result[precision] = training_step_peak_memory(conf_file, {"BATCH_SIZE": batch_size, "PRECISION": precision})
+        print("{}: peak memory {:.0f} MB ({:.1f}% of {})".format(
+            precision, result[precision] / 2.0 ** 20, 100.0 * result[precision] / max(result[precisions[0]], 1),
+            precisions[0]))
+    return result
+
+
+def training_step_peak_memory(conf_file="config.json", config_overrides=None):
+    """
+    Build the model with config_overrides in a new process and return the peak memory of one training step (after
+    a warm up step) on a random BATCH_SIZE batch, measured with peak_memory_bytes: the GPU allocator peak on GPU,
+    the peak resident set size of the process on CPU.
+    """
+    # the peak of a process only goes up, a new process for every configuration starts from zero
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(_training_step_peak_memory, (conf_file, config_overrides))
+
+
+def _training_step_peak_memory(conf_file, config_overrides):
+    model = SegNet(conf_file, config_overrides=config_overrides)
+    batch_size = model.batch_size
+    with model.graph.as_default():
+        loss, _, _ = normal_loss(logits=model.logits, labels=model.labels_pl, number_class=model.num_classes)
+        train, _ = train_op(total_loss=loss, opt=model.opt, loss_scale=model.config.get("LOSS_SCALE", 1.0))
+        model.sess.run(tf.global_variables_initializer())
+    feed_dict = {model.inputs_pl: np.random.rand(batch_size, model.input_h, model.input_w,
+                                                 model.input_c).astype(np.float32),
+                 model.labels_pl: np.random.randint(model.num_classes, size=(batch_size, model.input_h,
+                                                                             model.input_w, 1)),
+                 model.is_training_pl: True,
+                 model.keep_prob_pl: 0.5,
+                 model.with_dropout_pl: True}
+    model.sess.run(train, feed_dict=feed_dict)  # warm up
+    peak = peak_memory_bytes(model.sess, train, feed_dict)
+    model.sess.close()
+    return peak
+
+
+def compare_input_modes(conf_file="config.json", num_steps=101, batch_size=3):
+    """
+    Train num_steps steps with the feed_dict input path and with the direct input path and print the mean time of
+    a training step for both (the first step is left out, it includes the graph warm up).
+    """
+    step_time = {}
+    for input_mode in ["feed_dict", "direct"]:
+        model = SegNet(conf_file)
+        model.config["INPUT_MODE"] = input_mode
+        model.train(max_steps=num_steps, batch_size=batch_size)
+        step_time[input_mode] = np.mean(model.step_times[1:])
+        model.sess.close()
+    print("Mean step time: feed_dict {:.4f} s, direct {:.4f} s ({:.1f}% faster)".format(
+        step_time["feed_dict"], step_time["direct"],
+        100.0 * (step_time["feed_dict"] - step_time["direct"]) / step_time["feed_dict"]))
+    return step_time
+
+
+def benchmark_tiled(conf_file="config.json", checkpoint=None, sizes=(("1080p", 1080, 1920), ("4K", 2160, 3840)),
+                    num_runs=3):
+    """
+    Throughput of predict_tiled on random frames of the given sizes. Without checkpoint the weights are only
+    initialized, which does not change the time.
+    """
+    model = SegNet(conf_file)
+    if checkpoint is None:
+        with model.graph.as_default():
+            model.sess.run(tf.global_variables_initializer())
+    else:
+        model.restore(checkpoint)
+    result = {}
+    for name, image_h, image_w in sizes:
+        image = np.random.rand(image_h, image_w, model.input_c).astype(np.float32) * 255
+        model.predict_tiled(image)  # warm up
+        start_time = time.time()
+        for i in range(num_runs):
+            model.predict_tiled(image)
+        duration = (time.time() - start_time) / num_runs
+        result[name] = duration
+        print("{} ({}x{}): {:.2f} s/frame, {:.3f} frames/sec, {:.2f} Mpixel/sec".format(
+            name, image_w, image_h, duration, 1.0 / duration, image_h * image_w / duration / 1e6))
+    model.sess.close()
+    return result
+
+
+def compare_stream(conf_file="config.json", checkpoint=None, num_images=100, batch_size=None):
+    """
+    End-to-end images/sec of predict_stream against the sequential path of visual_results (read the image, run
+    the model, colour the label map, one stage after the other) on the first num_images images of TEST_FILE.
+    """
+    model = SegNet(conf_file)
+    model.restore(checkpoint)
+    batch_size = batch_size or model.batch_size
+    image_filename, _ = get_filename_list(model.config["TEST_FILE"], model.config)
+    paths = image_filename[:num_images]
+    feed_dict = {model.is_training_pl: False,
+                 model.keep_prob_pl: 1.0,
+                 model.with_dropout_pl: False}
+    feed_dict[model.inputs_pl] = read_image(paths[0])[np.newaxis]
+    model.sess.run(model.prob, feed_dict=feed_dict)  # warm up
+
+    start_time = time.time()
+    for i in range(0, len(paths), batch_size):
+        feed_dict[model.inputs_pl] = np.stack([read_image(path) for path in paths[i:i + batch_size]])
+        for prob in model.sess.run(model.prob, feed_dict=feed_dict):
+            _labels_and_colours(prob)
+    sequential = len(paths) / (time.time() - start_time)
+
+    start_time = time.time()
+    for _ in model.predict_stream(paths, batch_size=batch_size):
+        pass
+    pipelined = len(paths) / (time.time() - start_time)
+    model.sess.close()
+    print("sequential {:.2f} images/sec, predict_stream {:.2f} images/sec ({:.2f}x)".format(
+        sequential, pipelined, pipelined / sequential))
+    return sequential, pipelined
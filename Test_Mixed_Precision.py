@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+This script is used to check that the mixed precision mode of layers_object gives the same results as float32 on CPU:
+the conv layer (float16 compute, float32 weights and batch norm), the pooling and the unpooling.
+"""
+import tensorflow as tf
+import numpy as np
+from layers_object import conv_layer, max_pool, up_sampling
+
+
+def Test_Conv_Layer(compute_dtype = tf.float16, shape = [2,90,120,64]):
+    gen_array = np.random.rand(*shape).astype(np.float32)
+    with tf.Graph().as_default():
+        xplaceholder = tf.placeholder(tf.float32,shape)
+        is_training = tf.placeholder(tf.bool)
+        out32 = conv_layer(xplaceholder,'conv_test',[3,3,shape[3],shape[3]],is_training)
+        with tf.variable_scope(tf.get_variable_scope(),reuse = True):
+            #same weights, but the layer computes in compute_dtype
+            out16 = conv_layer(tf.cast(xplaceholder,compute_dtype),'conv_test',[3,3,shape[3],shape[3]],is_training)
+        pool32,index32,shape32 = max_pool(out32,'pool_32')
+        pool16,index16,shape16 = max_pool(out16,'pool_16')
+        unpool16 = up_sampling(pool16,index16,shape16,name='unpool_16')
+        #the float16 conv output goes into the fused batch norm, its weights and moving statistics stay float32
+        assert all(var.dtype.base_dtype == tf.float32 for var in tf.global_variables())
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {xplaceholder:gen_array, is_training:False}
+            v32,v16,p32,p16,i32,i16,u16 = sess.run([out32,out16,pool32,pool16,index32,index16,unpool16],feed_dict)
+    print('conv layer output dtype', v16.dtype, 'unpooling output dtype', u16.dtype)
+    conv_error = np.max(np.abs(v32-v16.astype(np.float32)))/np.max(np.abs(v32))
+    pool_error = np.max(np.abs(p32-p16.astype(np.float32)))/np.max(np.abs(p32))
+    #the argmax can flip between two nearly equal values, so only most of the indices have to be the same
+    index_match = np.mean(i32==i16)
+    print('relative max error conv layer %.5f, pooling %.5f, same pooling index %.4f'%(conv_error,pool_error,index_match))
+    #float16 has a 10 bit mantissa, so the relative error of one layer should be around 1e-3
+    assert conv_error < 1e-2
+    assert pool_error < 1e-2
+    assert index_match > 0.99
+    print('activation memory per conv layer output: %.1f MB float32, %.1f MB %s'
+          %(np.prod(shape)*4/2.0**20,np.prod(shape)*compute_dtype.size/2.0**20,compute_dtype.name))
+    return conv_error,pool_error,index_match
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+This script is used to check the gradient checkpointing of layers_object.conv_block: a block built with
+recompute=True must give the same output and the same gradients for its weights as the same block without it, and
+its batch norm moving statistics must only be updated once per step.
+"""
+import tensorflow as tf
+import numpy as np
+from layers_object import conv_block
+
+
+def Test_Recompute_Gradients(shape = [2,45,60,16], num_layers = 3):
+    gen_array = np.random.rand(*shape).astype(np.float32)
+    grad_weight = np.random.rand(*shape).astype(np.float32)
+    layer_shapes = [[3,3,shape[3],shape[3]]]*num_layers
+    #the same initial weights for both blocks, given as "VGG" parameters under the names of both blocks
+    param_dict = {}
+    for mode in ['plain','recompute']:
+        for i,layer_shape in enumerate(layer_shapes):
+            param_dict['%s_%d'%(mode,i)] = [np.random.RandomState(i).randn(*layer_shape).astype(np.float32)*0.1,
+                                            np.zeros(layer_shape[3],dtype=np.float32)]
+    with tf.Graph().as_default():
+        xplaceholder = tf.placeholder(tf.float32,shape)
+        is_training = tf.placeholder(tf.bool)
+        grads = {}
+        outputs = {}
+        for mode in ['plain','recompute']:
+            params = [('%s_%d'%(mode,i),layer_shape) for i,layer_shape in enumerate(layer_shapes)]
+            block = conv_block(xplaceholder,params,is_training,use_vgg=True,vgg_param_dict=param_dict,
+                               recompute=(mode=='recompute'))
+            variables = [var for var in tf.trainable_variables() if var.op.name.startswith(mode)]
+            assert len(variables) == 2*num_layers, mode
+            loss = tf.reduce_sum(block[-1]*grad_weight)
+            block_grads = tf.gradients(loss,variables)
+            assert all(grad is not None for grad in block_grads), mode
+            grads[mode] = block_grads
+            outputs[mode] = block[-1]
+        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+        print('%d batch norm update ops for %d layers'%(len(update_ops),2*num_layers))
+        #one moving mean and one moving variance update per layer, none from the recomputed pass
+        assert len(update_ops) == 2*2*num_layers
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            feed_dict = {xplaceholder:gen_array, is_training:True}
+            out,grad_values = sess.run([outputs,grads],feed_dict)
+    assert np.allclose(out['plain'],out['recompute'],atol=1e-5)
+    max_error = 0.0
+    for plain,recompute in zip(grad_values['plain'],grad_values['recompute']):
+        max_error = max(max_error,np.max(np.abs(plain-recompute))/max(np.max(np.abs(plain)),1e-12))
+    print('relative max gradient difference %.2e'%max_error)
+    assert max_error < 1e-4
+    return max_error
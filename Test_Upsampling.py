@@ -7,6 +7,7 @@ Created on Mon Nov 20 11:18:45 2017
 
 import tensorflow as tf
 import numpy as np
+import time
 
 
 def unpool_with_argmax(pool, ind, shape_ori, name = None, ksize=[1, 2, 2, 1]):
@@ -42,9 +43,14 @@ def unpool_with_argmax(pool, ind, shape_ori, name = None, ksize=[1, 2, 2, 1]):
         return ret
     
 def max_pool(inputs,name):
-    value,index = tf.nn.max_pool_with_argmax(tf.to_double(inputs),ksize=[1,2,2,1],strides=[1,2,2,1],padding='SAME',name=name)
+    value,index = tf.nn.max_pool_with_argmax(inputs,ksize=[1,2,2,1],strides=[1,2,2,1],padding='SAME',name=name)
     print('value shape',value.shape)
     print('index shape',index.shape)
+    return value,index,inputs.get_shape().as_list()
+
+def max_pool_double(inputs,name):
+    #the old implementation, everything is casted to float64 before the pooling
+    value,index = tf.nn.max_pool_with_argmax(tf.to_double(inputs),ksize=[1,2,2,1],strides=[1,2,2,1],padding='SAME',name=name)
     return tf.to_float(value),index,inputs.get_shape().as_list()
     
 def Test_Upsampling():
@@ -87,6 +93,101 @@ def Test_Upsampling():
 
 
 
+def Test_Pool_Precision(batch_size = 3, num_runs = 10):
+    #compare the float32 max_pool with the old float64 round trip on the inputs of the five pooling layers:
+    #the values and the argmax indices should be identical, and report the memory and the time saved per layer
+    layer_shapes = {'pool1':[batch_size,360,480,64],
+                    'pool2':[batch_size,180,240,128],
+                    'pool3':[batch_size,90,120,256],
+                    'pool4':[batch_size,45,60,512],
+                    'pool5':[batch_size,23,30,512]}
+    result = {}
+    for name in sorted(layer_shapes):
+        shape = layer_shapes[name]
+        gen_array = np.random.rand(*shape).astype(np.float32)
+        with tf.Graph().as_default():
+            xplaceholder = tf.placeholder(tf.float32,shape)
+            value32,index32,_ = max_pool(xplaceholder,name+'_32')
+            value64,index64,_ = max_pool_double(xplaceholder,name+'_64')
+            with tf.Session() as sess:
+                feed_dict = {xplaceholder:gen_array}
+                maxv32,maxi32,maxv64,maxi64 = sess.run([value32,index32,value64,index64],feed_dict)
+                time_tot = []
+                for fetches in [[value32,index32],[value64,index64]]:
+                    sess.run(fetches,feed_dict)
+                    start_time = time.time()
+                    for i in range(num_runs):
+                        sess.run(fetches,feed_dict)
+                    time_tot.append((time.time()-start_time)/num_runs)
+        assert np.array_equal(maxv32,maxv64), name
+        assert np.array_equal(maxi32,maxi64), name
+        #the double path keeps a float64 copy of the input and a float64 output before casting it back
+        saved_bytes = 8*np.prod(shape) + 8*np.prod(maxv32.shape)
+        print('%s: values and indices identical, %.1f MB less memory, %.2f ms (float32) vs %.2f ms (float64)'
+              %(name,saved_bytes/2.0**20,time_tot[0]*1000,time_tot[1]*1000))
+        result[name] = [saved_bytes,time_tot[0],time_tot[1]]
+    return result
+
+
+
+def Benchmark_Unpooling(batch_sizes = [1,3,8], num_runs = 10):
+    #compare the scatter_nd unpooling and the mask based unpooling from layers_object on the five unpooling
+    #shapes of SegNet: same output, gradients flowing back to the pooled values, and the forward+backward time
+    from layers_object import up_sampling
+    layer_shapes = {'unpool_1':[360,480,64],
+                    'unpool_2':[180,240,128],
+                    'unpool_3':[90,120,256],
+                    'unpool_4':[45,60,512],
+                    'unpool_5':[23,30,512]}
+    result = {}
+    for batch_size in batch_sizes:
+        for name in sorted(layer_shapes):
+            shape = [batch_size]+layer_shapes[name]
+            gen_array = np.random.rand(*shape).astype(np.float32)
+            with tf.Graph().as_default():
+                xplaceholder = tf.placeholder(tf.float32,shape)
+                value,index,oridex = max_pool(xplaceholder,'test')
+                time_tot = []
+                out_tot = []
+                for mode in ['scatter','mask']:
+                    unpool = up_sampling(value,index,oridex,name=name+'_'+mode,mode=mode)
+                    grad = tf.gradients(tf.reduce_sum(unpool*xplaceholder),value)[0]
+                    assert grad is not None, mode
+                    with tf.Session() as sess:
+                        feed_dict = {xplaceholder:gen_array}
+                        out,_ = sess.run([unpool,grad],feed_dict)
+                        start_time = time.time()
+                        for i in range(num_runs):
+                            sess.run([unpool,grad],feed_dict)
+                        time_tot.append((time.time()-start_time)/num_runs)
+                    out_tot.append(out)
+            assert np.array_equal(out_tot[0],out_tot[1]), name
+            print('batch %d %s %s: scatter %.2f ms, mask %.2f ms'%(batch_size,name,shape,time_tot[0]*1000,time_tot[1]*1000))
+            result[(batch_size,name)] = time_tot
+    return result
+
+
+
+def Test_Dynamic_Shape(shapes = [[1,9,7,4],[3,10,15,4],[2,23,30,4]]):
+    #one graph with unknown batch, height and width: both unpooling modes of layers_object, fed with batches of
+    #different sizes (odd heights and widths included), must give back a tensor of the input shape that holds
+    #every pooled value at its argmax position
+    from layers_object import max_pool as max_pool_dynamic, up_sampling
+    with tf.Graph().as_default():
+        xplaceholder = tf.placeholder(tf.float32,[None,None,None,4])
+        value,index,oridex = max_pool_dynamic(xplaceholder,'test')
+        unpools = [up_sampling(value,index,oridex,name='unpool_'+mode,mode=mode) for mode in ['scatter','mask']]
+        with tf.Session() as sess:
+            for shape in shapes:
+                gen_array = np.random.rand(*shape).astype(np.float32)
+                maxv,out_scatter,out_mask = sess.run([value]+unpools,{xplaceholder:gen_array})
+                assert out_scatter.shape == tuple(shape), shape
+                assert np.array_equal(out_scatter,out_mask), shape
+                assert np.allclose(np.sort(out_scatter[out_scatter>0]),np.sort(maxv[maxv>0])), shape
+                print('%s -> pooled %s -> unpooled %s'%(shape,maxv.shape,out_scatter.shape))
+
+
+
 def Test_Gradient():
     indices = tf.placeholder(tf.int64,(None,2))
     values = tf.placeholder(tf.float32,(None,))
@@ -0,0 +1,140 @@
+"""
+This file is utilized for data parallel training of SegNet on one machine with several CPU processes (or devices):
+a local cluster with one parameter server and N workers (between-graph replication with tf.train.Server).
+Every worker builds its own replica of the SegNet graph and trains on its own part of every global batch, the
+gradients of the N replicas are averaged by SyncReplicasOptimizer before every update (the all-reduce goes through
+the parameter server). All the variables, including the batch norm moving statistics, live on the parameter server,
+so the replicas always use the same weights and the same batch norm statistics.
+"""
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from SegNet import SegNet
+from evaluation_object import normal_loss, get_optimizer
+from inputs_object import get_filename_list, make_dataset
+
+
+def local_cluster_spec(num_workers, base_port=2222):
+    return {"ps": ["localhost:%d" % base_port],
+            "worker": ["localhost:%d" % (base_port + 1 + i) for i in range(num_workers)]}
+
+
+def _session_config(num_workers):
+    # split the cores of the machine between the workers
+    num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+    return tf.ConfigProto(intra_op_parallelism_threads=num_threads, inter_op_parallelism_threads=2)
+
+
+def run_ps(cluster_spec):
+    cluster = tf.train.ClusterSpec(cluster_spec)
+    server = tf.train.Server(cluster, job_name="ps", task_index=0, config=_session_config(1))
+    server.join()
+
+
+def run_worker(task_index, cluster_spec, conf_file, num_steps, batch_size, result_queue):
+    """
+    Train one replica for num_steps synchronous steps with batch_size images per step, and put the training time
+    (without the first step, which includes the start up) in result_queue.
+    """
+    num_workers = len(cluster_spec["worker"])
+    is_chief = task_index == 0
+    cluster = tf.train.ClusterSpec(cluster_spec)
+    server = tf.train.Server(cluster, job_name="worker", task_index=task_index,
+                             config=_session_config(num_workers))
+    device = tf.train.replica_device_setter(worker_device="/job:worker/task:%d" % task_index, cluster=cluster)
+
+    model = SegNet(conf_file, config_overrides={"BATCH_SIZE": batch_size}, device=device)
+    model.sess.close()
+    with model.graph.as_default(), tf.device(device):
+        # every worker reads its own shard of the training list
+        image_filename, label_filename = get_filename_list(model.config["TRAIN_FILE"], model.config)
+        dataset = make_dataset(image_filename[task_index::num_workers], label_filename[task_index::num_workers],
+                               batch_size, model.config)
+        handle_op = dataset.make_one_shot_iterator().string_handle()
+
+        loss, accuracy, _ = normal_loss(logits=model.logits, labels=model.labels_pl, number_class=model.num_classes)
+        global_step = tf.train.get_or_create_global_step()
+        optimizer = tf.train.SyncReplicasOptimizer(get_optimizer(model.opt, global_step),
+                                                   replicas_to_aggregate=num_workers,
+                                                   total_num_replicas=num_workers)
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            train = optimizer.minimize(loss, global_step=global_step)
+        hooks = [optimizer.make_session_run_hook(is_chief), tf.train.StopAtStepHook(last_step=num_steps)]
+
+        # the session, its scaffold and the hooks have to be created in the replica graph, not the default graph
+        with tf.train.MonitoredTrainingSession(master=server.target, is_chief=is_chief, hooks=hooks,
+                                               config=_session_config(num_workers)) as sess:
+            feed_dict = {model.input_handle_pl: sess.run(handle_op),
+                         model.is_training_pl: True,
+                         model.keep_prob_pl: 0.5,
+                         model.with_dropout_pl: True}
+            step_times = []
+            while not sess.should_stop():
+                start_time = time.time()
+                _, _loss, step = sess.run([train, loss, global_step], feed_dict=feed_dict)
+                step_times.append(time.time() - start_time)
+                print("Worker {} step {}: Train Loss {:6.3f}".format(task_index, step, _loss))
+    result_queue.put((task_index, np.sum(step_times[1:]), len(step_times) - 1))
+
+
+def train_local_cluster(num_workers, conf_file="config.json", num_steps=50, global_batch_size=8, base_port=2222):
+    """
+    Start a parameter server and num_workers worker processes, every worker gets global_batch_size / num_workers
+    images of every global batch. Output: global throughput in images/sec.
+    """
+    if global_batch_size % num_workers != 0:
+        raise ValueError("The global batch size has to be a multiple of the number of workers")
+    cluster_spec = local_cluster_spec(num_workers, base_port)
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    ps = context.Process(target=run_ps, args=(cluster_spec,))
+    ps.daemon = True
+    ps.start()
+    workers = [context.Process(target=run_worker, args=(i, cluster_spec, conf_file, num_steps,
+                                                        global_batch_size // num_workers, result_queue))
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    results = []
+    while len(results) < num_workers:
+        try:
+            results.append(result_queue.get(timeout=10))
+        except queue.Empty:
+            # a worker which died (e.g. an exception while building its graph) never puts its result
+            failed = [i for i, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+            if failed:
+                for worker in workers:
+                    worker.terminate()
+                ps.terminate()
+                raise RuntimeError("Worker(s) %s failed, see their output above" % failed)
+    for worker in workers:
+        worker.join()
+    ps.terminate()
+
+    # the steps are synchronous, so the slowest worker gives the time of the global steps
+    duration = max(result[1] for result in results)
+    num_global_steps = min(result[2] for result in results)
+    images_per_sec = num_global_steps * global_batch_size / duration
+    print("{} workers: {:.2f} images/sec".format(num_workers, images_per_sec))
+    return images_per_sec
+
+
+def scaling_report(max_workers=4, conf_file="config.json", num_steps=50, global_batch_size=8):
+    """
+    Throughput and scaling efficiency (throughput / (N * throughput with 1 worker)) from 1 to max_workers workers,
+    only the numbers of workers that divide global_batch_size are used.
+    """
+    throughput = {}
+    for num_workers in range(1, max_workers + 1):
+        if global_batch_size % num_workers == 0:
+            # a new port range for every cluster, the old servers may still hold theirs
+            throughput[num_workers] = train_local_cluster(num_workers, conf_file, num_steps, global_batch_size,
+                                                          base_port=2222 + 10 * num_workers)
+    for num_workers in sorted(throughput):
+        print("{} workers: {:.2f} images/sec, scaling efficiency {:.1f}%".format(
+            num_workers, throughput[num_workers], 100.0 * throughput[num_workers] / (num_workers * throughput[1])))
+    return throughput
@@ -1,39 +1,88 @@
-import matplotlib.pyplot as plt
 from PIL import Image
+import time
 import numpy as np
 
-def writeImage(image):
+# the default palette (config key PALETTE), the CamVid colours of Sky, Building, Pole, Road_marking, Road,
+# Pavement, Tree, SignSymbol, Fence, Car, Pedestrian, Bicyclist and Unlabelled
+LABEL_COLOURS = [[128,128,128], [128,0,0], [192,192,128], [255,69,0], [128,64,128], [60,40,222], [128,128,0],
+                 [192,128,128], [64,64,128], [64,0,128], [64,64,0], [0,128,192], [0,0,0]]
+
+
+def palette_lut(palette=None):
+    """ lookup table [max(256, num_classes + 1), 3] uint8 with the colour of every label, the labels without a
+    colour in the palette are black, the last row is always black (see colour_image) """
+    palette = np.asarray(LABEL_COLOURS if palette is None else palette, dtype=np.uint8)
+    lut = np.zeros((max(256, palette.shape[0] + 1), 3), dtype=np.uint8)
+    lut[:palette.shape[0]] = palette
+    return lut
+
+
+def colour_image(image, palette=None):
+    """ label map [height, width] -> uint8 RGB image [height, width, 3], one lookup per pixel in palette_lut, the
+    labels outside the palette (negative ones included) are black """
+    lut = palette_lut(palette)
+    image = np.asarray(image)
+    if np.issubdtype(image.dtype, np.signedinteger):
+        # mode='clip' would map the negative labels to the first colour
+        image = np.where(image < 0, len(lut) - 1, image)
+    # np.take is faster than lut[image], mode='clip' maps the labels above the table to its last row, which is black
+    return np.take(lut, image, axis=0, mode='clip')
+
+
+def write_label_png(path, labels, palette=None):
+    """ write a label map [height, width] as an indexed-colour PNG: one byte per pixel, the colours in the palette """
+    palette = LABEL_COLOURS if palette is None else palette
+    if len(palette) > 256:
+        raise ValueError("An indexed-colour PNG can only hold 256 colours")
+    im = Image.fromarray(np.asarray(labels, dtype=np.uint8), mode='P')
+    im.putpalette([value for colour in palette for value in colour])
+    im.save(path, format='PNG')
+
+
+def writeImage(image, palette=None):
     """ store label data to colored image """
-    Sky = [128,128,128]
-    Building = [128,0,0]
-    Pole = [192,192,128]
-    Road_marking = [255,69,0]
-    Road = [128,64,128]
-    Pavement = [60,40,222]
-    Tree = [128,128,0]
-    SignSymbol = [192,128,128]
-    Fence = [64,64,128]
-    Car = [64,0,128]
-    Pedestrian = [64,64,0]
-    Bicyclist = [0,128,192]
-    Unlabelled = [0,0,0]
-    r = image.copy()
-    g = image.copy()
-    b = image.copy()
-    label_colours = np.array([Sky, Building, Pole, Road_marking, Road, Pavement, Tree, SignSymbol, Fence, Car, Pedestrian, Bicyclist, Unlabelled])
-    for l in range(0,12):
-        r[image==l] = label_colours[l,0]
-        g[image==l] = label_colours[l,1]
-        b[image==l] = label_colours[l,2]
-    rgb = np.zeros((image.shape[0], image.shape[1], 3))
-    rgb[:,:,0] = r/1.0
-    rgb[:,:,1] = g/1.0
-    rgb[:,:,2] = b/1.0
-    im = Image.fromarray(np.uint8(rgb))
-    plt.imshow(im)
-    
+    import matplotlib.pyplot as plt
+    plt.imshow(Image.fromarray(colour_image(image, palette)))
+
+
+def benchmark_colour_image(num_images=100, image_h=360, image_w=480, num_classes=12):
+    """
+    Compare colour_image with the per-class masking loop that writeImage used before, on random label maps. The
+    labels are limited to the classes of LABEL_COLOURS, the loop has no colour for the others.
+    """
+    num_classes = min(num_classes, len(LABEL_COLOURS))
+    labels = np.random.randint(0, num_classes, size=(num_images, image_h, image_w)).astype(np.uint8)
+
+    start_time = time.time()
+    loop_images = []
+    label_colours = np.array(LABEL_COLOURS)
+    for image in labels:
+        r = image.copy()
+        g = image.copy()
+        b = image.copy()
+        for l in range(len(LABEL_COLOURS)):
+            r[image==l] = label_colours[l,0]
+            g[image==l] = label_colours[l,1]
+            b[image==l] = label_colours[l,2]
+        rgb = np.zeros((image.shape[0], image.shape[1], 3))
+        rgb[:,:,0] = r/1.0
+        rgb[:,:,1] = g/1.0
+        rgb[:,:,2] = b/1.0
+        loop_images.append(np.uint8(rgb))
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    lut_images = [colour_image(image) for image in labels]
+    lut_time = time.time() - start_time
+
+    assert all(np.array_equal(a, b) for a, b in zip(loop_images, lut_images))
+    print('colouring %d label maps: loop %.3f s, lookup table %.3f s (%.0fx faster)' % (
+        num_images, loop_time, lut_time, loop_time / lut_time))
+    return loop_time, lut_time
+
+
 def draw_plots(images, labels, predicted_labels):
-    
+    import matplotlib.pyplot as plt
     num_images = len(images)
     
     cols = ['Input', 'Ground truth', 'Output']
@@ -134,19 +134,56 @@ def print_hist_summary(hist):
     """
     This function is copied from "Implement slightly different segnet on tensorflow"
     """
-    acc_total = np.diag(hist).sum() / hist.sum()
+    acc_total, class_acc, iu = hist_metrics(hist)
     print('accuracy = %f' % np.nanmean(acc_total))
-    iu = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
     print('mean IU  = %f' % np.nanmean(iu))
     for ii in range(hist.shape[0]):
-        if float(hist.sum(1)[ii]) == 0:
-            acc = 0.0
-        else:
-            acc = np.diag(hist)[ii] / float(hist.sum(1)[ii])
-        print("    class # %d accuracy = %f " % (ii, acc))
+        print("    class # %d accuracy = %f " % (ii, class_acc[ii]))
+
+
+def hist_metrics(hist):
+    """
+    Global accuracy, per class accuracy (0 for the classes without any pixel) and per class IU from a confusion
+    matrix with the true labels on the rows and the predictions on the columns.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    acc_total = np.diag(hist).sum() / hist.sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        class_acc = np.where(hist.sum(1) == 0, 0.0, np.diag(hist) / hist.sum(1))
+        iu = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
+    return acc_total, class_acc, iu
+
+
+def confusion_matrix(labels, predictions, num_class):
+    """
+    In-graph version of fast_hist over a whole batch: a [num_class, num_class] int64 confusion matrix, the labels
+    outside [0, num_class) are ignored.
+    """
+    label_flatten = tf.to_int64(tf.reshape(labels, [-1]))
+    pred_flatten = tf.to_int64(tf.reshape(predictions, [-1]))
+    valid = tf.logical_and(label_flatten >= 0, label_flatten < num_class)
+    return tf.confusion_matrix(tf.boolean_mask(label_flatten, valid), tf.boolean_mask(pred_flatten, valid),
+                               num_classes=num_class, dtype=tf.int64)
+
+
+def streaming_confusion_matrix(labels, predictions, num_class, name='streaming_confusion_matrix'):
+    """
+    Confusion matrix accumulated inside the graph, so only the [num_class, num_class] matrix has to be fetched
+    instead of the logits of every batch.
+    Output:
+    hist: local variable with the accumulated confusion matrix
+    update_op: adds the confusion matrix of the current batch to hist
+    reset_op: sets hist back to zero (it also initializes it)
+    """
+    with tf.variable_scope(name):
+        hist = tf.Variable(tf.zeros([num_class, num_class], dtype=tf.int64), trainable=False,
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES], name='hist')
+        update_op = tf.assign_add(hist, confusion_matrix(labels, predictions, num_class))
+        reset_op = tf.assign(hist, tf.zeros_like(hist))
+    return hist, update_op, reset_op
 
 
-def train_op(total_loss, opt):
+def train_op(total_loss, opt, loss_scale=1.0):
     """
     Input:
     total_loss: The loss 
@@ -157,6 +194,9 @@ def train_op(total_loss, opt):
     by the graph.. Reference: https://stackoverflow.com/questions/41166681/what-does-tensorflow-global-step-mean
     FLAG: utilized to denote which optimization method are we using, because for segnet, we can easily use Adam, but
     for segnet bayes, from the paper it says SGD will be more helpful to learn. 
+    loss_scale: for mixed precision training, the loss is multiplied by loss_scale before the gradients are computed
+    (so the small float16 gradients do not underflow) and the gradients are divided by it again before they are
+    applied to the float32 weights.
     Output
     The train_op
     """
@@ -164,18 +204,60 @@ def train_op(total_loss, opt):
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
 
     with tf.control_dependencies(update_ops):
-        if (opt == "ADAM"):
-            optimizer = tf.train.AdamOptimizer(0.001)
-            print("Running with Adam Optimizer with learning rate:", 0.001)
-        elif (opt == "SGD"):
-            base_learning_rate = 0.001
-            learning_rate = tf.train.exponential_decay(base_learning_rate, global_step, decay_rate=0.0005)
-            optimizer = tf.train.GradientDescentOptimizer(learning_rate)
-            print("Running with Gradient Descent Optimizer with learning rate", 0.001)
-        else:
-            raise ValueError("Optimizer is not recognized")
+        optimizer = get_optimizer(opt, global_step)
 
-        grads = optimizer.compute_gradients(total_loss, var_list=tf.trainable_variables())
+        grads = optimizer.compute_gradients(total_loss * loss_scale, var_list=tf.trainable_variables())
+        if loss_scale != 1.0:
+            grads = [(grad / loss_scale if grad is not None else None, var) for grad, var in grads]
         training_op = optimizer.apply_gradients(grads, global_step=global_step)
 
     return training_op, global_step
+
+
+def accumulating_train_op(total_loss, opt, accum_steps, loss_scale=1.0):
+    """
+    Gradient accumulation: the gradients of accum_steps micro-batches are summed before one optimizer update, so
+    the effective batch is accum_steps times the batch that fits in memory.
+    Output:
+    accumulate_op: run once per micro-batch, adds its gradients to the sums and updates the batch norm moving
+    statistics (UPDATE_OPS) with the statistics of that micro-batch
+    apply_op: run after accum_steps micro-batches, applies the mean gradient, increments global_step (so
+    global_step counts optimizer updates, not micro-batches) and sets the sums back to zero
+    global_step
+    """
+    global_step = tf.Variable(0, trainable=False)
+    update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+    optimizer = get_optimizer(opt, global_step)
+
+    grads = optimizer.compute_gradients(total_loss * loss_scale, var_list=tf.trainable_variables())
+    grads = [(grad, var) for grad, var in grads if grad is not None]
+    with tf.variable_scope('gradient_accumulation'):
+        grad_sums = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES], name=var.op.name.replace('/', '_'))
+                     for _, var in grads]
+    with tf.control_dependencies(update_ops):
+        accumulate_op = tf.group(*[grad_sum.assign_add(grad) for grad_sum, (grad, _) in zip(grad_sums, grads)])
+
+    mean_grads = [(grad_sum / (accum_steps * loss_scale), var) for grad_sum, (_, var) in zip(grad_sums, grads)]
+    update_op = optimizer.apply_gradients(mean_grads, global_step=global_step)
+    with tf.control_dependencies([update_op]):
+        apply_op = tf.group(*[grad_sum.assign(tf.zeros_like(grad_sum)) for grad_sum in grad_sums])
+
+    return accumulate_op, apply_op, global_step
+
+
+def get_optimizer(opt, global_step):
+    """
+    The optimizer for the flag opt, "ADAM" or "SGD".
+    """
+    if (opt == "ADAM"):
+        optimizer = tf.train.AdamOptimizer(0.001)
+        print("Running with Adam Optimizer with learning rate:", 0.001)
+    elif (opt == "SGD"):
+        base_learning_rate = 0.001
+        learning_rate = tf.train.exponential_decay(base_learning_rate, global_step, decay_rate=0.0005)
+        optimizer = tf.train.GradientDescentOptimizer(learning_rate)
+        print("Running with Gradient Descent Optimizer with learning rate", 0.001)
+    else:
+        raise ValueError("Optimizer is not recognized")
+    return optimizer
@@ -0,0 +1,328 @@
+"""
+This file is utilized to export a trained SegNet checkpoint as a standalone inference graph.
+The batch norm moving statistics are folded into the weights and biases of every conv layer, so the exported graph
+is only conv2d + bias + relu, max pooling and unpooling, without variables, placeholders other than the images or
+any training branch. The weights can be exported in float32 or quantized to 8 bits (post-training quantization,
+the activation ranges are calibrated on a sample of the TRAIN_FILE images).
+"""
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from layers_object import max_pool, up_sampling
+from evaluation_object import get_hist, print_hist_summary, hist_metrics
+from inputs_object import get_filename_list, make_dataset
+from SegNet import SegNet
+
+BN_EPSILON = 0.001  # default epsilon of tf.contrib.layers.batch_norm, used by layers_object.batch_norm
+
+ENCODER_BLOCKS = [["conv1_1", "conv1_2"],
+                  ["conv2_1", "conv2_2"],
+                  ["conv3_1", "conv3_2", "conv3_3"],
+                  ["conv4_1", "conv4_2", "conv4_3"],
+                  ["conv5_1", "conv5_2", "conv5_3"]]
+DECODER_BLOCKS = [["deconv5_2", "deconv5_3", "deconv5_4"],
+                  ["deconv4_2", "deconv4_3", "deconv4_4"],
+                  ["deconv3_2", "deconv3_3", "deconv3_4"],
+                  ["deconv2_2", "deconv2_3"],
+                  ["deconv1_2", "deconv1_3"]]
+CLASSIFIER = "conv_classifier"
+
+
+def fold_batch_norm(checkpoint, epsilon=BN_EPSILON):
+    """
+    Read the conv layers of a SegNet checkpoint and fold the batch norm into them. The batch norm of conv_layer has
+    no offset and no scale (center=False), so relu(bn(conv(x, w) + b)) = relu(conv(x, w') + b') with
+    w' = w / sqrt(moving_variance + epsilon) and b' = (b - moving_mean) / sqrt(moving_variance + epsilon).
+    Output: dict layer name -> (kernel, bias) in float32, the classifier included
+    """
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    params = {}
+    for name in [layer for block in ENCODER_BLOCKS + DECODER_BLOCKS for layer in block]:
+        kernel = reader.get_tensor(name + "/weights")
+        # the encoder layers initialized from VGG store their bias as biases_1
+        bias = _checkpoint_tensor(reader, name + "/biases", name + "/biases_1")
+        scale = 1.0 / np.sqrt(reader.get_tensor(name + "/" + name + "/moving_variance") + epsilon)
+        params[name] = ((kernel * scale).astype(np.float32),
+                        ((bias - reader.get_tensor(name + "/" + name + "/moving_mean")) * scale).astype(np.float32))
+    params[CLASSIFIER] = (reader.get_tensor(CLASSIFIER + "/weights").astype(np.float32),
+                          reader.get_tensor(CLASSIFIER + "/biases").astype(np.float32))
+    return params
+
+
+def _checkpoint_tensor(reader, *names):
+    for name in names:
+        if reader.has_tensor(name):
+            return reader.get_tensor(name)
+    raise KeyError("None of %s is in the checkpoint" % ", ".join(names))
+
+
+def inference_net(images, conv, unpool_mode="scatter"):
+    """
+    The SegNet forward pass without dropout and batch norm. conv(inputs, name, relu) builds the conv layer name,
+    so the same network is used for the float and the quantized graph.
+    Output: logits
+    """
+    net = tf.nn.lrn(images, depth_radius=5, bias=1.0, alpha=0.0001, beta=0.75, name='norm1')
+    pool_outputs = []
+    for i, block in enumerate(ENCODER_BLOCKS):
+        for name in block:
+            net = conv(net, name)
+        net, index, shape = max_pool(net, 'pool%d' % (i + 1))
+        pool_outputs.append((index, shape))
+    for i, block in enumerate(DECODER_BLOCKS):
+        index, shape = pool_outputs.pop()
+        net = up_sampling(net, index, shape, name="unpool_%d" % (len(DECODER_BLOCKS) - i), mode=unpool_mode)
+        for name in block:
+            net = conv(net, name)
+    return conv(net, CLASSIFIER, relu=False)
+
+
+def float_conv(params):
+    def conv(inputs, name, relu=True):
+        kernel, bias = params[name]
+        with tf.name_scope(name):
+            outputs = tf.nn.conv2d(inputs, tf.constant(kernel, name="weights"), [1, 1, 1, 1], padding='SAME')
+            outputs = tf.nn.bias_add(outputs, tf.constant(bias, name="biases"))
+            return tf.nn.relu(outputs) if relu else outputs
+    return conv
+
+
+def quantize_weights(kernel):
+    """
+    8 bit quantization of a kernel with the MIN_COMBINED scheme of tf.quantize_v2 for quint8:
+    kernel ~ w_min + q * (w_max - w_min) / 255. The range always contains 0.
+    Output: q (uint8), w_min, w_max
+    """
+    w_min, w_max = min(float(kernel.min()), 0.0), max(float(kernel.max()), 0.0)
+    scale = (w_max - w_min) / 255.0 if w_max > w_min else 1.0
+    return np.round((kernel - w_min) / scale).astype(np.uint8), w_min, w_max
+
+
+def quantized_conv(params, input_ranges):
+    """
+    Conv layers with 8 bit weights and activations: the input is quantized with its calibrated range, the
+    convolution runs on quint8 and accumulates in qint32, the bias and the relu are applied after the
+    dequantization. input_ranges: dict layer name -> (min, max) of its input, see calibrate.
+    """
+    quantized = {name: (quantize_weights(kernel), bias) for name, (kernel, bias) in params.items()}
+
+    def conv(inputs, name, relu=True):
+        (q_kernel, w_min, w_max), bias = quantized[name]
+        in_min, in_max = input_ranges[name]
+        in_max = max(in_max, in_min + 1e-6)  # quantize_v2 needs a non empty range
+        with tf.name_scope(name):
+            # the graph stores the weights as uint8, 1/4 of the float32 size
+            kernel = tf.bitcast(tf.constant(q_kernel, name="weights"), tf.quint8)
+            q_inputs, q_min, q_max = tf.quantize_v2(inputs, in_min, in_max, tf.quint8)
+            outputs, out_min, out_max = tf.nn.quantized_conv2d(q_inputs, kernel, q_min, q_max, w_min, w_max,
+                                                                strides=[1, 1, 1, 1], padding='SAME')
+            outputs = tf.nn.bias_add(tf.dequantize(outputs, out_min, out_max), tf.constant(bias, name="biases"))
+            return tf.nn.relu(outputs) if relu else outputs
+    return conv
+
+
+def build_inference_graph(conv, input_shape, unpool_mode="scatter"):
+    """
+    Output: graph with the input "images" and the outputs "logits" and "prediction"
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        images = tf.placeholder(tf.float32, input_shape, name="images")
+        logits = tf.identity(inference_net(images, conv, unpool_mode), name="logits")
+        tf.argmax(logits, axis=-1, name="prediction")
+    return graph
+
+
+def write_inference_graph(graph, path):
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph.as_graph_def().SerializeToString())
+    print("Wrote %s (%.1f MB)" % (path, tf.gfile.Stat(path).length / 1e6))
+
+
+def load_inference_graph(path):
+    """
+    Output: graph, images placeholder, logits
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    return graph, graph.get_tensor_by_name("images:0"), graph.get_tensor_by_name("logits:0")
+
+
+def numpy_batches(list_path, batch_size, config, max_images=None):
+    """
+    Batches of (images, labels) of list_path as numpy arrays, read with the same pipeline as the training.
+    The last batch can be smaller than batch_size.
+    """
+    image_filename, label_filename = get_filename_list(list_path, config)
+    if max_images is not None:
+        image_filename, label_filename = image_filename[:max_images], label_filename[:max_images]
+    with tf.Graph().as_default():
+        dataset = make_dataset(image_filename, label_filename, batch_size, config, shuffle=False, repeat=False)
+        images, labels = dataset.make_one_shot_iterator().get_next()
+        with tf.Session() as sess:
+            while True:
+                try:
+                    yield sess.run([images, labels])
+                except tf.errors.OutOfRangeError:
+                    return
+
+
+def calibrate(params, batches, input_shape):
+    """
+    Run the float graph over the calibration batches and record the min and max of the input of every conv layer.
+    Output: dict layer name -> (min, max)
+    """
+    conv_inputs = {}
+    conv = float_conv(params)
+
+    def recording_conv(inputs, name, relu=True):
+        conv_inputs[name] = inputs
+        return conv(inputs, name, relu)
+
+    graph = build_inference_graph(recording_conv, input_shape)
+    input_ranges = {}
+    with tf.Session(graph=graph) as sess:
+        images = graph.get_tensor_by_name("images:0")
+        for image_batch, _ in batches:
+            values = sess.run(conv_inputs, feed_dict={images: _pad_batch(image_batch, input_shape[0])})
+            for name, value in values.items():
+                old_min, old_max = input_ranges.get(name, (0.0, 0.0))
+                input_ranges[name] = (min(old_min, float(value.min())), max(old_max, float(value.max())))
+    return input_ranges
+
+
+def _pad_batch(batch, batch_size):
+    # repeat the last image up to a full batch, the graph has a fixed batch size
+    if batch_size is None or batch.shape[0] == batch_size:
+        return batch
+    return np.concatenate([batch, np.repeat(batch[-1:], batch_size - batch.shape[0], axis=0)], axis=0)
+
+
+def export_quantized(checkpoint=None, conf_file="config.json", output_path="segnet_int8.pb", num_calibration=50,
+                     batch_size=1):
+    """
+    Fold the batch norm of checkpoint (SAVE_MODEL_DIR by default), calibrate the activation ranges on the first
+    num_calibration images of TRAIN_FILE and write the 8 bit inference graph to output_path.
+    """
+    with open(conf_file) as f:
+        config = json.load(f)
+    input_shape = [batch_size, config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]]
+    params = fold_batch_norm(checkpoint or config["SAVE_MODEL_DIR"])
+    input_ranges = calibrate(params, numpy_batches(config["TRAIN_FILE"], batch_size, config, num_calibration),
+                             input_shape)
+    graph = build_inference_graph(quantized_conv(params, input_ranges), input_shape)
+    write_inference_graph(graph, output_path)
+    return graph
+
+
+def evaluate_inference_graph(graph, list_path, batch_size, config, num_classes):
+    """
+    Confusion matrix and mean latency per image of an inference graph on the images of list_path.
+    """
+    images = graph.get_tensor_by_name("images:0")
+    logits = graph.get_tensor_by_name("logits:0")
+    hist = np.zeros((num_classes, num_classes))
+    duration, num_images = 0.0, 0
+    with tf.Session(graph=graph) as sess:
+        for image_batch, label_batch in numpy_batches(list_path, batch_size, config):
+            num_valid = image_batch.shape[0]
+            start_time = time.time()
+            logits_value = sess.run(logits, feed_dict={images: _pad_batch(image_batch, batch_size)})
+            duration += time.time() - start_time
+            hist += get_hist(logits_value[:num_valid], label_batch)
+            num_images += num_valid
+    return hist, duration / num_images
+
+
+def quantization_report(checkpoint=None, conf_file="config.json", num_calibration=50, batch_size=1):
+    """
+    Accuracy and latency of the 8 bit graph against the float32 graph (both with the batch norm folded) on
+    TEST_FILE.
+    """
+    with open(conf_file) as f:
+        config = json.load(f)
+    input_shape = [batch_size, config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]]
+    params = fold_batch_norm(checkpoint or config["SAVE_MODEL_DIR"])
+    input_ranges = calibrate(params, numpy_batches(config["TRAIN_FILE"], batch_size, config, num_calibration),
+                             input_shape)
+    graphs = [("float32", build_inference_graph(float_conv(params), input_shape)),
+              ("int8", build_inference_graph(quantized_conv(params, input_ranges), input_shape))]
+    results = {}
+    for name, graph in graphs:
+        hist, latency = evaluate_inference_graph(graph, config["TEST_FILE"], batch_size, config,
+                                                 config["NUM_CLASSES"])
+        print("---- %s ----" % name)
+        print_hist_summary(hist)
+        print("latency = %.1f ms/image" % (latency * 1000))
+        acc_total, _, iu = hist_metrics(hist)
+        results[name] = (acc_total, np.nanmean(iu), latency)
+    print("int8 vs float32: accuracy %+.4f, mean IU %+.4f, %.2fx faster" % (
+        results["int8"][0] - results["float32"][0], results["int8"][1] - results["float32"][1],
+        results["float32"][2] / results["int8"][2]))
+    return results
+
+
+def freeze_checkpoint(checkpoint=None, conf_file="config.json", output_path="segnet_frozen.pb"):
+    """
+    Freeze a checkpoint written by SegNet.save (SAVE_MODEL_DIR by default) into a minimal float32 inference graph:
+    batch norm folded into the conv layers, no is_training/labels placeholders, dropout or loss ops, and a variable
+    batch dimension (the unpooling uses the "mask" mode of up_sampling, which has no fixed batch size).
+    """
+    with open(conf_file) as f:
+        config = json.load(f)
+    input_shape = [None, config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]]
+    graph = build_inference_graph(float_conv(fold_batch_norm(checkpoint or config["SAVE_MODEL_DIR"])), input_shape,
+                                  unpool_mode="mask")
+    write_inference_graph(graph, output_path)
+    return graph
+
+
+def freeze_report(frozen_path="segnet_frozen.pb", checkpoint=None, conf_file="config.json", num_images=20):
+    """
+    Startup time (until the first prediction is done) and latency per image of the frozen graph against the
+    SegNet training graph restored from the checkpoint, on the first num_images images of TEST_FILE one at a time.
+    """
+    with open(conf_file) as f:
+        config = json.load(f)
+    image_batches = [images for images, _ in numpy_batches(config["TEST_FILE"], 1, config, num_images)]
+
+    start_time = time.time()
+    model = SegNet(conf_file, config_overrides={"BATCH_SIZE": 1})
+    model.restore(checkpoint)
+    feed_dict = {model.is_training_pl: False, model.keep_prob_pl: 1.0, model.with_dropout_pl: False}
+
+    def run_checkpoint(images):
+        feed_dict[model.inputs_pl] = images
+        return model.sess.run(model.logits, feed_dict=feed_dict)
+    checkpoint_times = _time_model(run_checkpoint, image_batches, start_time)
+    model.sess.close()
+
+    start_time = time.time()
+    graph, images_pl, logits = load_inference_graph(frozen_path)
+    sess = tf.Session(graph=graph)
+    frozen_times = _time_model(lambda images: sess.run(logits, feed_dict={images_pl: images}), image_batches,
+                               start_time)
+    sess.close()
+
+    for name, (startup, latency) in [("checkpoint", checkpoint_times), ("frozen", frozen_times)]:
+        print("%s: startup %.2f s, latency %.1f ms/image" % (name, startup, latency * 1000))
+    print("frozen graph: startup %.2fx faster, latency %.2fx faster" % (checkpoint_times[0] / frozen_times[0],
+                                                                      checkpoint_times[1] / frozen_times[1]))
+    return checkpoint_times, frozen_times
+
+
+def _time_model(run, image_batches, start_time):
+    # startup: from start_time to the end of the first prediction, latency: mean over the other images
+    run(image_batches[0])
+    startup = time.time() - start_time
+    start_time = time.time()
+    for images in image_batches[1:]:
+        run(images)
+    return startup, (time.time() - start_time) / max(len(image_batches) - 1, 1)
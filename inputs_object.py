@@ -2,6 +2,7 @@ import tensorflow as tf
 from tensorflow.python.framework import ops
 from tensorflow.python.framework import dtypes
 import os
+import time
 import numpy as np
 import scipy
 from scipy import misc
@@ -42,60 +43,167 @@ def dataset_reader(filename_queue, config):  # prev name: CamVid_reader
 
 
 def dataset_inputs(image_filenames, label_filenames, batch_size, config):
+    """
+    Build the training/validation input pipeline on top of tf.data.
+    The PNG decoding is done by NUM_PARALLEL_CALLS workers, the decoded batches are kept in a prefetch buffer of
+    PREFETCH_BATCHES batches, and the shuffling order is fixed by SHUFFLE_SEED (null means a random order).
+    Inputs:
+    image_filenames, label_filenames: list of filenames, see get_filename_list
+    batch_size: number of images per batch
+    config: the loaded config.json
+    Output:
+    images: 4D tensor of [batch_size, height, width, 3] float32
+    labels: 4D tensor of [batch_size, height, width, 1] uint8
+    """
+    dataset = make_dataset(image_filenames, label_filenames, batch_size, config)
+    return _iterator_batch(dataset, batch_size, config)
+
+
+def packed_dataset_inputs(list_path, batch_size, config):
+    """
+    Same as dataset_inputs, but serves the batches from the pre-decoded cache written by pack_dataset, so no PNG is
+    decoded during training. The cache is built on the first call if it is not in CACHE_DIR yet.
+    """
+    dataset = make_packed_dataset(list_path, batch_size, config)
+    return _iterator_batch(dataset, batch_size, config)
+
+
+def _iterator_batch(dataset, batch_size, config):
+    images, labels = dataset.make_one_shot_iterator().get_next()
+    images.set_shape([batch_size, config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]])
+    labels.set_shape([batch_size, config["INPUT_HEIGHT"], config["INPUT_WIDTH"], 1])
+
+    print('generating image and label batch:')
+    return images, labels
+
+
+def make_dataset(image_filenames, label_filenames, batch_size, config, shuffle=True, repeat=True):
+    """
+    The tf.data.Dataset behind dataset_inputs. With repeat=True the dataset never ends, so every batch is full;
+    with repeat=False (one pass, e.g. for testing) the last batch can be smaller than batch_size.
+    """
+    num_parallel_calls = config.get("NUM_PARALLEL_CALLS", 4)
+    prefetch_batches = config.get("PREFETCH_BATCHES", 2)
+    seed = config.get("SHUFFLE_SEED", None)
+
     images = ops.convert_to_tensor(image_filenames, dtype=dtypes.string)
     labels = ops.convert_to_tensor(label_filenames, dtype=dtypes.string)
-
-    filename_queue = tf.train.slice_input_producer([images, labels], shuffle=True)
-
-    image, label = dataset_reader(filename_queue, config)
-    reshaped_image = tf.cast(image, tf.float32)
-    min_queue_examples = 300
-    print('Filling queue with %d input images before starting to train. '
-          'This may take some time.' % min_queue_examples)
-
-    # Generate a batch of images and labels by building up a queue of examples.
-    return _generate_image_and_label_batch(reshaped_image, label,
-                                           min_queue_examples, batch_size,
-                                           shuffle=True)
-
-
-def _generate_image_and_label_batch(image, label, min_queue_examples,
-                                    batch_size, shuffle):
-    """Construct a queued batch of images and labels.
-    Args:
-        image: 3-D Tensor of [height, width, 3] of type.float32.
-        label: 3-D Tensor of [height, width, 1] type.int32
-        min_queue_examples: int32, minimum number of samples to retain
-        in the queue that provides of batches of examples.
-        batch_size: Number of images per batch.
-        shuffle: boolean indicating whether to use a shuffling queue.
-    Returns:
-        images: Images. 4D tensor of [batch_size, height, width, 3] size.
-        labels: Labels. 3D tensor of [batch_size, height, width ,1] size.
-    """
-    # Create a queue that shuffles the examples, and then
-    # read 'batch_size' images + labels from the example queue.
-
-    # TODO: test if setting threads to higher number!
-    num_preprocess_threads = 1
+    dataset = tf.data.Dataset.from_tensor_slices((images, labels))
     if shuffle:
-        images, label_batch = tf.train.shuffle_batch(
-            [image, label],
-            batch_size=batch_size,
-            num_threads=num_preprocess_threads,
-            capacity=min_queue_examples + 3 * batch_size,
-            min_after_dequeue=min_queue_examples)
-    else:
-        images, label_batch = tf.train.batch(
-            [image, label],
-            batch_size=batch_size,
-            num_threads=num_preprocess_threads,
-            capacity=min_queue_examples + 3 * batch_size)
-
-    # Display the training images in the visualizer.
-    tf.summary.image('training_images', images)
-    print('generating image and label batch:')
-    return images, label_batch
+        # shuffle over the whole list (only strings are buffered), reshuffled every epoch
+        dataset = dataset.shuffle(len(image_filenames), seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+
+    def _parse(image_filename, label_filename):
+        image, label = dataset_reader((image_filename, label_filename), config)
+        return tf.cast(image, tf.float32), label
+
+    dataset = dataset.map(_parse, num_parallel_calls=num_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    return dataset.prefetch(prefetch_batches)
+
+
+def _packed_paths(list_path, config):
+    name = os.path.splitext(os.path.basename(list_path))[0]
+    return (os.path.join(config["CACHE_DIR"], name + "_images.npy"),
+            os.path.join(config["CACHE_DIR"], name + "_labels.npy"))
+
+
+def pack_dataset(list_path, config):
+    """
+    One-time "pack" step: decode every image/label pair listed in list_path (train.txt, val.txt or test.txt) and
+    store them as two contiguous uint8 arrays in CACHE_DIR, [N, height, width, 3] for the images and
+    [N, height, width, 1] for the labels. The .npy files are written under a temporary name and renamed at the end,
+    so an interrupted pack never leaves a half written cache behind.
+    """
+    image_path, label_path = _packed_paths(list_path, config)
+    if os.path.exists(image_path) and os.path.exists(label_path):
+        return image_path, label_path
+    if not os.path.isdir(config["CACHE_DIR"]):
+        os.makedirs(config["CACHE_DIR"])
+
+    image_filenames, label_filenames = get_filename_list(list_path, config)
+    num_images = len(image_filenames)
+    height, width, channels = config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]
+    images = np.lib.format.open_memmap(image_path + ".part", mode="w+", dtype=np.uint8,
+                                       shape=(num_images, height, width, channels))
+    labels = np.lib.format.open_memmap(label_path + ".part", mode="w+", dtype=np.uint8,
+                                       shape=(num_images, height, width, 1))
+    for i, (im_filename, la_filename) in enumerate(zip(image_filenames, label_filenames)):
+        images[i] = np.reshape(scipy.misc.imread(im_filename), (height, width, channels))
+        labels[i] = np.reshape(scipy.misc.imread(la_filename), (height, width, 1))
+    images.flush()
+    labels.flush()
+    del images, labels
+    os.rename(image_path + ".part", image_path)
+    os.rename(label_path + ".part", label_path)
+    print('%d images from %s are packed into %s' % (num_images, list_path, config["CACHE_DIR"]))
+    return image_path, label_path
+
+
+def load_packed_dataset(list_path, config):
+    """
+    Memory-map the cache written by pack_dataset (packing it first if needed). Nothing is read from disk until
+    the arrays are sliced, and warm pages come straight from the page cache.
+    """
+    image_path, label_path = pack_dataset(list_path, config)
+    return np.load(image_path, mmap_mode="r"), np.load(label_path, mmap_mode="r")
+
+
+def packed_batches(images, labels, batch_size, seed=None, contiguous=False):
+    """
+    Endless generator of random (image, label) batches from the memory-mapped arrays.
+    contiguous=False: every epoch is a new permutation of the images, a batch is a single gather (one memcpy).
+    contiguous=True: every epoch shuffles the order of batch-sized blocks (with a random start offset), and a
+    batch is a zero-copy slice of the memory map. Less random, but cheaper.
+    """
+    rng = np.random.RandomState(seed)
+    num_images = images.shape[0]
+    while True:
+        if contiguous:
+            offset = rng.randint(batch_size)
+            starts = np.arange(offset, num_images - batch_size + 1, batch_size)
+            for start in rng.permutation(starts):
+                yield images[start:start + batch_size], labels[start:start + batch_size]
+        else:
+            order = rng.permutation(num_images)
+            for start in range(0, num_images - batch_size + 1, batch_size):
+                index = np.sort(order[start:start + batch_size])  # sorted reads are sequential on disk
+                yield images[index], labels[index]
+
+
+def make_packed_dataset(list_path, batch_size, config):
+    """
+    tf.data.Dataset of batches served from the memory-mapped cache, see packed_batches.
+    """
+    images, labels = load_packed_dataset(list_path, config)
+    height, width, channels = config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]
+    dataset = tf.data.Dataset.from_generator(
+        lambda: packed_batches(images, labels, batch_size, config.get("SHUFFLE_SEED", None),
+                               config.get("CACHE_CONTIGUOUS", False)),
+        (tf.uint8, tf.uint8),
+        (tf.TensorShape([batch_size, height, width, channels]), tf.TensorShape([batch_size, height, width, 1])))
+    dataset = dataset.map(lambda image, label: (tf.cast(image, tf.float32), label))
+    return dataset.prefetch(config.get("PREFETCH_BATCHES", 2))
+
+
+def benchmark_inputs(image_filenames, label_filenames, batch_size, config, num_batches=100):
+    """
+    Measure how many images per second the input pipeline delivers on its own (no model attached).
+    """
+    with tf.Graph().as_default():
+        images, labels = dataset_inputs(image_filenames, label_filenames, batch_size, config)
+        with tf.Session() as sess:
+            sess.run([images, labels])  # warm up, fills the prefetch buffer
+            start_time = time.time()
+            for _ in range(num_batches):
+                sess.run([images, labels])
+            duration = time.time() - start_time
+    images_per_sec = num_batches * batch_size / duration
+    print('input pipeline: %d batches of %d in %.2f s, %.1f images/sec' % (num_batches, batch_size, duration,
+                                                                        images_per_sec))
+    return images_per_sec
 
 
 def get_all_test_data(im_list, la_list):
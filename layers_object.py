@@ -3,27 +3,33 @@ Created on Tue Nov 21 10:09:39 2017
 This file is utilized to denote different layers, there are conv_layer, conv_layer_enc, max_pool, up_sampling
 @author: s161488
 """
-import numpy as np
 import tensorflow as tf
 import math
+from tensorflow.python.framework import tensor_util
 
 
 def max_pool(inputs, name):
+    # pooling runs in the dtype of the inputs, float32 -> float64 is exact, so the argmax indices are the same as
+    # with the old tf.to_double round trip, but without the double sized copy of every encoder activation
     with tf.variable_scope(name) as scope:
-        value, index = tf.nn.max_pool_with_argmax(tf.to_double(inputs), ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+        value, index = tf.nn.max_pool_with_argmax(inputs, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
                                                   padding='SAME', name=scope.name)
-    return tf.to_float(value), index, inputs.get_shape().as_list()
+    # the shape is returned as a tensor, so the batch size and the image size can change from run to run. With
+    # padding 'SAME' an odd height or width is pooled to ceil(size / 2), up_sampling crops back to this shape
+    return value, index, tf.shape(inputs)
     # here value is the max value, index is the corresponding index, the detail information is here
     # https://www.tensorflow.org/versions/r1.0/api_docs/python/tf/nn/max_pool_with_argmax
 
 
-def conv_layer(bottom, name, shape, is_training, use_vgg=False, vgg_param_dict=None):
+def conv_layer(bottom, name, shape, is_training, use_vgg=False, vgg_param_dict=None, is_recomputing=False):
     """
     Inputs:
     bottom: The input image or tensor
     name: corresponding layer's name
     shape: the shape of kernel size
     training_state: represent if the weight should update 
+    is_recomputing: True when conv_block builds the layer again for the backward pass (recompute), the batch norm
+    moving statistics are not updated a second time and no summaries are added
     Output:
     The output from layers
     :param use_vgg:
@@ -38,6 +44,9 @@ def conv_layer(bottom, name, shape, is_training, use_vgg=False, vgg_param_dict=N
         return vgg_param_dict[val_name][1]
         # here load the bias for VGG-16, the bias size will be 64,128,256,512,512, also shown in function vgg_param_load
 
+    # The layer computes in the dtype of bottom (float32, or float16/bfloat16 for mixed precision). The weights are
+    # always stored in float32 and casted. The fused batch norm takes the float16 conv output directly, its moving
+    # statistics and the normalization are in float32 inside the kernel, so no float32 copy of the output is kept.
     with tf.variable_scope(name) as scope:
         if use_vgg:
             init = tf.constant_initializer(get_conv_filter(scope.name))
@@ -45,8 +54,9 @@ def conv_layer(bottom, name, shape, is_training, use_vgg=False, vgg_param_dict=N
         else:
             filt = variable_with_weight_decay('weights', initializer=initialization(shape[0], shape[2]),
                                               shape=shape, wd=False)
-        tf.summary.histogram(scope.name + "weight", filt)
-        conv = tf.nn.conv2d(bottom, filt, [1, 1, 1, 1], padding='SAME')
+        if not is_recomputing:
+            tf.summary.histogram(scope.name + "weight", filt)
+        conv = tf.nn.conv2d(bottom, tf.cast(filt, bottom.dtype), [1, 1, 1, 1], padding='SAME')
         if use_vgg:
             conv_biases_init = tf.constant_initializer(get_biases(scope.name))
             conv_biases = variable_with_weight_decay('biases_1', initializer=conv_biases_init, shape=shape[3], wd=False)
@@ -54,17 +64,60 @@ def conv_layer(bottom, name, shape, is_training, use_vgg=False, vgg_param_dict=N
             conv_biases = variable_with_weight_decay('biases', initializer=tf.constant_initializer(0.0),
                                                      shape=shape[3],
                                                      wd=False)
-        tf.summary.histogram(scope.name + "bias", conv_biases)
-        bias = tf.nn.bias_add(conv, conv_biases)
-        conv_out = tf.nn.relu(batch_norm(bias, is_training, scope))
+        if not is_recomputing:
+            tf.summary.histogram(scope.name + "bias", conv_biases)
+        bias = tf.nn.bias_add(conv, tf.cast(conv_biases, bottom.dtype))
+        conv_out = tf.nn.relu(batch_norm(bias, is_training, scope, is_recomputing))
     return conv_out
 
 
-def batch_norm(bias_input, is_training, scope):
+def conv_block(bottom, layer_params, is_training, use_vgg=False, vgg_param_dict=None, recompute=False):
+    """
+    A stack of conv_layer, layer_params is the list of (layer name, kernel shape).
+    recompute: gradient checkpointing, only the input of the block is kept for the backward pass, the activations
+    inside the block are computed again from it when the gradients are needed
+    (tf.contrib.layers.recompute_grad). The block must not contain dropout, the recomputed pass would draw a
+    different mask. The batch norm moving statistics are only updated by the forward pass (is_recomputing).
+    Output: list with the output of every layer
+    """
+    outputs = []
+
+    def block(inputs, is_recomputing=False):
+        layer_outputs = []
+        for name, shape in layer_params:
+            inputs = conv_layer(inputs, name, shape, is_training, use_vgg, vgg_param_dict, is_recomputing)
+            layer_outputs.append(inputs)
+        if not is_recomputing:
+            # keep the tensors of the forward pass, recompute_grad calls block again for the backward pass
+            outputs.extend(layer_outputs)
+        return inputs
+
+    if recompute:
+        # recompute_grad only finds the weights of the block (and computes their gradients) if they are resource
+        # variables, the current scope is opened again with use_resource, so the variable names do not change
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            block_output = tf.contrib.layers.recompute_grad(block)(bottom)
+        # the last layer is the output of the recompute_grad op
+        outputs[-1] = block_output
+    else:
+        block(bottom)
+    return outputs
+
+
+def batch_norm(bias_input, is_training, scope, is_recomputing=False):
+    # the update ops of a recomputed pass are taken out of UPDATE_OPS again, the forward pass already updated the
+    # moving statistics with the same batch
+    update_ops = tf.get_collection_ref(tf.GraphKeys.UPDATE_OPS)
+    num_update_ops = len(update_ops)
     with tf.variable_scope(scope.name) as scope:
-        return tf.cond(is_training,
-                       lambda: tf.contrib.layers.batch_norm(bias_input, is_training=True, center=False, scope=scope),
-                       lambda: tf.contrib.layers.batch_norm(bias_input, is_training=False,center=False, reuse = True, scope=scope))
+        output = tf.cond(is_training,
+                         lambda: tf.contrib.layers.batch_norm(bias_input, is_training=True, center=False, fused=True,
+                                                              scope=scope),
+                         lambda: tf.contrib.layers.batch_norm(bias_input, is_training=False, center=False, fused=True,
+                                                              reuse=True, scope=scope))
+    if is_recomputing:
+        del update_ops[num_update_ops:]
+    return output
 #is_training = True, it will accumulate the statistics of the movements into moving_mean and moving_variance. When it's
 #not in a training mode, then it would use the values of the moving_mean, and moving_variance.
 #shadow_variable = decay * shadow_variable + (1 - decay) * variable, shadow_variable, I think it's the accumulated moving
@@ -72,25 +125,30 @@ def batch_norm(bias_input, is_training, scope):
 #to be True, but for the validation part, actually we should set it to be False!
 
 
-def up_sampling(pool, ind, output_shape, name=None):
+def up_sampling(pool, ind, output_shape, name=None, mode="scatter"):
     """
        Unpooling layer after max_pool_with_argmax.
        Args:
            pool:   max pooled output tensor
            ind:      argmax indices
-           ksize:     ksize is the same as for the pool
+           output_shape: shape of the tensor before the pooling, the 1-D shape tensor from max_pool (or a list)
+           mode:   "scatter" (tf.scatter_nd on the flattened indices) or "mask" (see up_sampling_mask)
        Return:
            unpool:    unpooling tensor
     """
+    if mode == "mask":
+        return up_sampling_mask(pool, ind, output_shape, name=name)
+    elif mode != "scatter":
+        raise ValueError("Unpooling mode is not recognized")
     with tf.variable_scope(name):
-        input_shape = pool.get_shape().as_list()
-        flat_input_size = np.prod(input_shape)
-        flat_output_shape = [output_shape[0], output_shape[1] * output_shape[2] * output_shape[3]]
-        pool_ = tf.reshape(pool, [flat_input_size])
-        batch_range = tf.reshape(tf.range(output_shape[0], dtype=ind.dtype), shape=[input_shape[0], 1, 1, 1])
+        static_shape = _static_shape(output_shape)
+        output_shape = tf.cast(output_shape, ind.dtype)
+        flat_output_shape = tf.stack([output_shape[0], output_shape[1] * output_shape[2] * output_shape[3]])
+        pool_ = tf.reshape(pool, [-1])
+        batch_range = tf.reshape(tf.range(output_shape[0], dtype=ind.dtype), shape=[-1, 1, 1, 1])
         b = tf.ones_like(ind) * batch_range
-        b = tf.reshape(b, [flat_input_size, 1])
-        ind_ = tf.reshape(ind, [flat_input_size, 1])
+        b = tf.reshape(b, [-1, 1])
+        ind_ = tf.reshape(ind, [-1, 1])
         ind_ = tf.concat([b, ind_], 1)
         ret = tf.scatter_nd(ind_, pool_, shape=flat_output_shape)
         # the reason that we use tf.scatter_nd: if we use tf.sparse_tensor_to_dense, then the gradient is None, which will cut off the network.
@@ -99,9 +157,50 @@ def up_sampling(pool, ind, output_shape, name=None):
         # zero tensor of given shape (FLAT_OUTPUT_SHAPE) according to the indices (ind_). If we ues the orignal code, the only thing we need to change is: changeing
         # from tf.sparse_tensor_to_dense(sparse_tensor) to tf.sparse_add(tf.zeros((output_sahpe)),sparse_tensor) which will give us the gradients!!!
         ret = tf.reshape(ret, output_shape)
+        ret.set_shape(static_shape)
         return ret
 
 
+def up_sampling_mask(pool, ind, output_shape, name=None):
+    """
+    Unpooling without the [N, 2] index matrix of tf.scatter_nd, only valid for the 2x2, stride 2 pooling of max_pool.
+    The argmax index of a pixel is (y * width + x) * channels + c, so the position of the maximum inside its 2x2
+    window is (y % 2, x % 2). It is computed in int32 at the pooled size, and every pooled value is written to that
+    position of its window (and 0 to the other three), the four window positions are interleaved into the output.
+    Nothing of the full output size is built except the output itself. The gradient flows to the pooled values
+    through the multiplication with the masks.
+    Inputs:
+    pool: max pooled output tensor, [batch, ceil(height / 2), ceil(width / 2), channels]
+    ind: argmax indices from max_pool (per image, the batch is not part of the index)
+    output_shape: shape of the tensor before the pooling, [batch, height, width, channels], the 1-D shape tensor
+    from max_pool (or a list)
+    """
+    with tf.variable_scope(name):
+        static_shape = _static_shape(output_shape)
+        output_shape = tf.cast(output_shape, tf.int32)
+        height, width, channels = output_shape[1], output_shape[2], output_shape[3]
+        ind = tf.cast(ind, tf.int32)
+        # window position of the maximum, 0: top left, 1: top right, 2: bottom left, 3: bottom right
+        window = (ind // (width * channels)) % 2 * 2 + (ind // channels) % width % 2
+        rows = []
+        for row in range(2):
+            row_values = [pool * tf.cast(tf.equal(window, row * 2 + col), pool.dtype) for col in range(2)]
+            # [batch, h, w, 2, channels], the two columns of every window next to each other
+            rows.append(tf.stack(row_values, axis=3))
+        # [batch, h, 2, w, 2, channels] -> [batch, 2h, 2w, channels]
+        shape = tf.shape(pool)
+        ret = tf.reshape(tf.stack(rows, axis=2), tf.stack([shape[0], shape[1] * 2, shape[2] * 2, shape[3]]))
+        # an odd height or width was padded by the pooling, the extra row/column is cropped
+        ret = ret[:, :height, :width, :]
+        ret.set_shape(static_shape)
+        return ret
+
+
+def _static_shape(output_shape):
+    # the part of the shape known when the graph is built, e.g. the channels, from the shape tensor of max_pool
+    return tensor_util.constant_value_as_shape(tf.convert_to_tensor(output_shape))
+
+
 def initialization(k, c):
     """
     Here the reference paper is https:arxiv.org/pdf/1502.01852
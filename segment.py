@@ -0,0 +1,174 @@
+"""
+Command line tool to segment a directory of frames or a video file with a trained SegNet checkpoint:
+
+    python segment.py INPUT OUTPUT_DIR [--checkpoint CKPT] [--config config.json] [--batch-size N]
+                      [--writers N] [--uncertainty] [--no-resume]
+
+Every frame is written to OUTPUT_DIR as an indexed-colour label PNG with the same name as the input image
+(frame_000123.png for the frames of a video). With --uncertainty the Monte Carlo dropout uncertainty maps of
+Bayesian SegNet (variance of the predicted class, entropy, mutual information) are written as <name>_uncertainty.npz
+next to it. The frames which already have a label PNG are skipped, so an interrupted run continues where it stopped.
+Reading videos needs OpenCV (cv2).
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from SegNet import SegNet, read_image
+from drawings_object import write_label_png
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def directory_frames(input_dir):
+    """
+    Output: sorted list of (name, image path) of the images in input_dir
+    """
+    names = sorted(name for name in os.listdir(input_dir) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [(os.path.splitext(name)[0], os.path.join(input_dir, name)) for name in names]
+
+
+def video_frames(video_path, skip=None):
+    """
+    Output: iterator over (name, RGB frame) of every frame of the video, the frames whose name is in skip are read
+    but not decoded into arrays. cv2 is imported and the video is opened here, not on the first frame, so a missing
+    OpenCV or a video which can not be read raises before the frames are handed to the model.
+    """
+    import cv2
+    capture = cv2.VideoCapture(video_path)
+    # the first frame is read here as well, some files open but have no frame the installed codecs can decode
+    ok, first_frame = capture.read() if capture.isOpened() else (False, None)
+    if not ok:
+        capture.release()
+        raise IOError("Can not read the video %s" % video_path)
+    return _read_video(cv2, capture, first_frame, skip)
+
+
+def _read_video(cv2, capture, first_frame, skip):
+    index = 0
+    try:
+        name = "frame_%06d" % index
+        if skip is None or name not in skip:
+            yield name, cv2.cvtColor(first_frame, cv2.COLOR_BGR2RGB)
+        index += 1
+        while True:
+            name = "frame_%06d" % index
+            if skip is not None and name in skip:
+                if not capture.grab():
+                    break
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield name, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            index += 1
+    finally:
+        capture.release()
+
+
+def _read_frame(item):
+    # the items of the directory are image paths, the items of the video are already decoded frames
+    name, source = item
+    if isinstance(source, np.ndarray):
+        return source.astype(np.float32)
+    return read_image(source)
+
+
+def _write_result(output_dir, name, labels, palette=None, uncertainty=None):
+    if uncertainty is not None:
+        np.savez_compressed(os.path.join(output_dir, name + "_uncertainty.npz"), **uncertainty)
+    # the label PNG is written last, its existence marks the frame as done for the resume
+    path = os.path.join(output_dir, name + ".png")
+    write_label_png(path + ".part", labels, palette)
+    os.rename(path + ".part", path)
+
+
+def segment(input_path, output_dir, checkpoint=None, conf_file="config.json", batch_size=None, writers=4,
+            uncertainty=False, resume=True):
+    """
+    Segment every frame of input_path (directory or video) into output_dir. Output: number of frames, frames/sec
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    done = set()
+    if resume:
+        done = set(os.path.splitext(name)[0] for name in os.listdir(output_dir) if name.endswith(".png"))
+    if not os.path.exists(input_path):
+        raise IOError("%s does not exist" % input_path)
+    if os.path.isdir(input_path):
+        frames = [(name, path) for name, path in directory_frames(input_path) if name not in done]
+    else:
+        frames = video_frames(input_path, skip=done)
+    if done:
+        print("Resuming, %d frames are already done" % len(done))
+
+    model = SegNet(conf_file)
+    model.restore(checkpoint)
+    palette = model.config.get("PALETTE")
+    write_pool = ThreadPoolExecutor(max_workers=writers)
+    pending = []
+    num_frames = 0
+    start_time = time.time()
+    if uncertainty:
+        # the Monte Carlo samples of one frame fill the batches of the graph, so the frames run one by one
+        for item in frames:
+            moments = model.mc_dropout_samples(_read_frame(item), model.config.get("MC_SAMPLES", 30),
+                                               tolerance=model.config.get("MC_TOLERANCE", None))
+            pred, var_one, entropy, mutual_info = moments.uncertainty_maps()
+            maps = {"variance": var_one.astype(np.float16), "entropy": entropy.astype(np.float16),
+                    "mutual_information": mutual_info.astype(np.float16)}
+            _submit(pending, writers, write_pool.submit(_write_result, output_dir, item[0], pred, palette, maps))
+            num_frames += 1
+            _report(num_frames, start_time)
+    else:
+        for item, labels in model.predict_stream(frames, batch_size=batch_size, read=_read_frame,
+                                                 postprocess=lambda prob: np.argmax(prob, axis=-1)):
+            _submit(pending, writers, write_pool.submit(_write_result, output_dir, item[0], labels, palette))
+            num_frames += 1
+            _report(num_frames, start_time)
+    for future in pending:
+        future.result()
+    write_pool.shutdown()
+    model.sess.close()
+    frames_per_sec = num_frames / max(time.time() - start_time, 1e-9)
+    print("Segmented %d frames, %.2f frames/sec" % (num_frames, frames_per_sec))
+    return num_frames, frames_per_sec
+
+
+def _submit(pending, writers, future):
+    # at most 4 frames per writer wait to be written, the model waits for the writers instead of the memory growing
+    pending.append(future)
+    while len(pending) > 4 * writers:
+        pending.pop(0).result()
+
+
+def _report(num_frames, start_time, interval=100):
+    if num_frames % interval == 0:
+        print("%d frames, %.2f frames/sec" % (num_frames, num_frames / (time.time() - start_time)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment a directory of frames or a video with SegNet")
+    parser.add_argument("input", help="directory of images or video file")
+    parser.add_argument("output_dir", help="directory for the label PNGs")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint to restore, SAVE_MODEL_DIR by default")
+    parser.add_argument("--config", default="config.json", help="config file")
+    parser.add_argument("--batch-size", type=int, default=None, help="frames per batch, BATCH_SIZE by default")
+    parser.add_argument("--writers", type=int, default=4, help="number of PNG writer threads")
+    parser.add_argument("--uncertainty", action="store_true",
+                        help="write the Monte Carlo dropout uncertainty maps (Bayesian SegNet)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="segment all the frames again instead of skipping the finished ones")
+    args = parser.parse_args()
+    try:
+        segment(args.input, args.output_dir, args.checkpoint, args.config, args.batch_size, args.writers,
+                args.uncertainty, args.resume)
+    except (IOError, ImportError) as e:
+        parser.exit(1, "segment.py: error: %s\n" % e)
+
+
+if __name__ == "__main__":
+    main()
@@ -112,9 +112,9 @@ def inference(images, labels, training_state):
 
 def max_pool(inputs, name):
     with tf.variable_scope(name) as scope:
-        value, index = tf.nn.max_pool_with_argmax(tf.to_double(inputs), ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
+        value, index = tf.nn.max_pool_with_argmax(inputs, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1],
                                                   padding='SAME', name=scope.name)
-    return tf.to_float(value), index, inputs.get_shape().as_list()
+    return value, index, inputs.get_shape().as_list()
 
 
 # here value is the max value, index is the corresponding index, the detail information is here
@@ -0,0 +1,246 @@
+"""
+This file is utilized to serve a trained SegNet over HTTP. The model is built and restored once, and the requests
+which arrive at the same time are run together: the batching thread waits for up to SERVE_MAX_BATCH requests, but
+never longer than SERVE_MAX_LATENCY_MS after the first one, and runs them in one batch (the requests are grouped by
+image size, the graph has no fixed batch or image size).
+
+POST /predict with a PNG/JPEG image (Content-Type image/png or image/jpeg) or a numpy array saved with np.save
+(Content-Type application/x-npy), ?output=labels (default, uint8 [height, width]) or ?output=prob (float32
+[height, width, num_classes]). The result is returned as a np.save array.
+"""
+import io
+import json
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import scipy.misc
+
+from SegNet import SegNet
+
+
+class BatchingPredictor(object):
+    """
+    Collects the requests of several threads into batches for one SegNet model. predict can be called from any
+    thread, only the batching thread runs the session.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_latency=0.02):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, image):
+        """
+        Output: softmax probabilities of image [height, width, channels], [height, width, num_classes]
+        """
+        if not self._running:
+            raise RuntimeError("predictor closed")
+        future = Future()
+        self.requests.put((np.asarray(image, dtype=np.float32), future))
+        if not self._running:
+            # close may have drained the queue before this request was put
+            self._fail_pending()
+        return future.result()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._fail_pending()
+
+    def _fail_pending(self):
+        # the requests nobody will run any more, their handler threads wait in future.result()
+        while True:
+            try:
+                _, future = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            future.set_exception(RuntimeError("predictor closed"))
+
+    def _next_batch(self):
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        feed_dict = {self.model.is_training_pl: False,
+                     self.model.keep_prob_pl: 1.0,
+                     self.model.with_dropout_pl: False}
+        while self._running:
+            batch = self._next_batch()
+            by_shape = {}
+            for image, future in batch:
+                by_shape.setdefault(image.shape, []).append((image, future))
+            for requests in by_shape.values():
+                feed_dict[self.model.inputs_pl] = np.stack([image for image, _ in requests])
+                try:
+                    prob_batch = self.model.sess.run(self.model.prob, feed_dict=feed_dict)
+                except Exception as e:
+                    for _, future in requests:
+                        future.set_exception(e)
+                    continue
+                self.batch_sizes.append(len(requests))
+                for (_, future), prob in zip(requests, prob_batch):
+                    future.set_result(prob)
+
+
+def decode_request(body, content_type, channels=3):
+    """
+    Output: the image of the request body, [height, width, channels]. Grey images are repeated to channels, the
+    alpha channel of an RGBA image is dropped, every other shape raises ValueError.
+    """
+    if content_type == "application/x-npy":
+        image = np.load(io.BytesIO(body))
+    elif content_type in ("image/png", "image/jpeg"):
+        image = scipy.misc.imread(io.BytesIO(body))
+    else:
+        raise ValueError("Content type %s is not supported" % content_type)
+    if image.ndim == 2:
+        image = np.stack([image] * channels, axis=-1)
+    elif image.ndim == 3 and image.shape[-1] == channels + 1 and channels == 3:
+        image = image[:, :, :channels]
+    if image.ndim != 3 or image.shape[-1] != channels:
+        raise ValueError("The image has to be [height, width, %d], got shape %s" % (channels, image.shape))
+    return image
+
+
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def make_handler(predictor):
+    class PredictHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/predict":
+                self.send_error(404)
+                return
+            output = parse_qs(url.query).get("output", ["labels"])[0]
+            try:
+                image = decode_request(self.rfile.read(int(self.headers["Content-Length"])),
+                                       self.headers.get("Content-Type"), predictor.model.input_c)
+                if output not in ("labels", "prob"):
+                    raise ValueError("output has to be labels or prob")
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+            try:
+                prob = predictor.predict(image)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            result = np.argmax(prob, axis=-1).astype(np.uint8) if output == "labels" else prob
+            body = encode_array(result)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-npy")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # one line per request would dominate the time of the load tests
+            pass
+
+    return PredictHandler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(conf_file="config.json", checkpoint=None, host="localhost", port=8500):
+    """
+    Build and restore the model (SAVE_MODEL_DIR by default) and start serving in a background thread.
+    Output: server (server.server_address has the port when port is 0), predictor
+    """
+    model = SegNet(conf_file)
+    model.restore(checkpoint)
+    predictor = BatchingPredictor(model, model.config.get("SERVE_MAX_BATCH", 8),
+                                  model.config.get("SERVE_MAX_LATENCY_MS", 20) / 1000.0)
+    server = ThreadingHTTPServer((host, port), make_handler(predictor))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print("Serving SegNet on http://%s:%d/predict" % server.server_address)
+    return server, predictor
+
+
+def stop_server(server, predictor):
+    server.shutdown()
+    server.server_close()
+    predictor.close()
+    predictor.model.sess.close()
+
+
+def load_test(url, images, num_requests=200, concurrency=8, output="labels"):
+    """
+    Send num_requests requests (the images in turn, as np.save arrays) from concurrency threads.
+    Output: latency of every request in seconds, throughput in requests/sec
+    """
+    bodies = [encode_array(np.asarray(image, dtype=np.float32)) for image in images]
+
+    def send(i):
+        request = urllib.request.Request(url + "?output=" + output, data=bodies[i % len(bodies)],
+                                         headers={"Content-Type": "application/x-npy"})
+        start_time = time.time()
+        with urllib.request.urlopen(request) as response:
+            np.load(io.BytesIO(response.read()))
+        return time.time() - start_time
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(send, range(num_requests)))
+    throughput = num_requests / (time.time() - start_time)
+    print("%d requests, concurrency %d: p50 %.1f ms, p99 %.1f ms, %.2f requests/sec" % (
+        num_requests, concurrency, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000,
+        throughput))
+    return latencies, throughput
+
+
+def serving_report(conf_file="config.json", checkpoint=None, num_requests=200, concurrencies=(1, 4, 16)):
+    """
+    Start a local server and run the load generator with random INPUT_HEIGHT x INPUT_WIDTH images at every
+    concurrency, the mean batch size shows how much the requests were coalesced.
+    """
+    with open(conf_file) as f:
+        config = json.load(f)
+    images = [np.random.rand(config["INPUT_HEIGHT"], config["INPUT_WIDTH"], config["INPUT_CHANNELS"]) * 255
+              for _ in range(4)]
+    server, predictor = start_server(conf_file, checkpoint, port=0)
+    url = "http://%s:%d/predict" % server.server_address
+    result = {}
+    try:
+        load_test(url, images, num_requests=4, concurrency=1)  # warm up
+        for concurrency in concurrencies:
+            predictor.batch_sizes = []
+            latencies, throughput = load_test(url, images, num_requests, concurrency)
+            print("    mean batch size %.2f" % np.mean(predictor.batch_sizes))
+            result[concurrency] = (np.percentile(latencies, 50), np.percentile(latencies, 99), throughput)
+    finally:
+        stop_server(server, predictor)
+    return result
@@ -0,0 +1,45 @@
+"""
+This file is utilized for the tiled (sliding window) inference of images larger than the training images: the
+positions of the overlapping tiles and the weights used to blend the logits of the tiles back together.
+"""
+import numpy as np
+
+
+def tile_starts(size, tile, overlap):
+    """
+    Start positions of tiles of length tile along an axis of length size, neighbouring tiles overlap by at least
+    overlap pixels, the last tile ends at the border of the image.
+    """
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError("The overlap has to be smaller than the tile size")
+    starts = list(range(0, size - tile, stride))
+    return starts + [size - tile]
+
+
+def tile_positions(image_h, image_w, tile_h, tile_w, overlap):
+    """
+    Output: list of (y, x) of the top left corner of every tile, the tiles are min(tile, image) large
+    """
+    return [(y, x) for y in tile_starts(image_h, tile_h, overlap) for x in tile_starts(image_w, tile_w, overlap)]
+
+
+def blend_weights(tile_h, tile_w, overlap, mode="linear"):
+    """
+    Weight of every pixel of a tile when the logits of overlapping tiles are averaged, [tile_h, tile_w].
+    "uniform": all the pixels have the same weight.
+    "linear": the weight goes up linearly over the first and the last overlap pixels of each axis, so the pixels
+    close to the border of a tile, which see less context, count less than the same pixels in the middle of the
+    neighbouring tile. The weights are never 0, so every pixel of the image is covered.
+    """
+    if mode == "uniform" or overlap <= 0:
+        return np.ones([tile_h, tile_w], dtype=np.float32)
+    elif mode != "linear":
+        raise ValueError("Blend mode is not recognized")
+
+    def ramp(length):
+        position = np.arange(length, dtype=np.float32)
+        return np.minimum(1.0, np.minimum(position + 1, length - position) / (overlap + 1.0))
+    return np.outer(ramp(tile_h), ramp(tile_w))
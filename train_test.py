@@ -5,6 +5,7 @@ import math
 from inputs import get_filename_list, dataset_inputs, get_all_test_data
 from evaluation import Normal_Loss, cal_loss, per_class_acc, get_hist, print_hist_summery, train_op
 from inference import segnet_vgg, segnet_scratch, segnet_bayes_scratch, segnet_bayes_vgg
+from uncertainty_object import RunningMoments
 
 NUM_CLASS = 12 
 def Test():
@@ -81,39 +82,28 @@ def Test():
                    loss_per, acc_per,logit,pred = sess.run(fetches = fetches, feed_dict = feed_dict)
                    var_one = []
                 else:
-                   logit_iter_tot = []
                    loss_iter_tot = []
                    acc_iter_tot = []
-                   prob_iter_tot = []
-                   logit_iter_temp = []
+                   #streaming mean/variance, only one image worth of probabilities and logits is kept in memory
+                   prob_moments = RunningMoments()
+                   logit_moments = RunningMoments()
                    for iter_step in range(num_sample_generate):
                        loss_iter_step, acc_iter_step, logit_iter_step,prob_iter_step = sess.run(fetches = [loss,accuracy,logits,prob], feed_dict = feed_dict)
                        loss_iter_tot.append(loss_iter_step)                    
                        acc_iter_tot.append(acc_iter_step)                    
-                       logit_iter_tot.append(logit_iter_step)
-                       prob_iter_tot.append(prob_iter_step)
-                       logit_iter_temp.append(np.reshape(logit_iter_step,[image_h,image_w,NUM_CLASS]))
+                       logit_moments.update(np.reshape(logit_iter_step,[1,image_h,image_w,NUM_CLASS]))
+                       prob_moments.update(np.reshape(prob_iter_step,[1,image_h,image_w,NUM_CLASS]))
                     
                    loss_per = np.nanmean(loss_iter_tot)
                    acc_per = np.nanmean(acc_iter_tot)
-                   logit = np.nanmean(logit_iter_tot,axis = 0)
-                   print(np.shape(prob_iter_tot))
+                   logit = np.reshape(logit_moments.mean,[1,image_h,image_w,NUM_CLASS])
                 
-                   prob_mean = np.nanmean(prob_iter_tot,axis = 0)
-                   prob_variance = np.var(prob_iter_tot, axis = 0)
-                   logit_variance = np.var(logit_iter_temp,axis = 0)
+                   prob_variance = prob_moments.variance
+                   logit_variance = logit_moments.variance
  
                 #THIS TIME I DIDN'T INCLUDE TAU
-                   pred = np.reshape(np.argmax(prob_mean,axis = -1),[-1]) #pred is the predicted label
-                
-                   var_sep = [] #var_sep is the corresponding variance if this pixel choose label k
-                   length_cur = 0 #length_cur represent how many pixels has been read for one images
-                   for row in np.reshape(prob_variance,[image_h*image_w,12]):
-                       temp = row[pred[length_cur]]
-                       length_cur += 1
-                       var_sep.append(temp)
-                   var_one = np.reshape(var_sep,[image_h,image_w]) #var_one is the corresponding variance in terms of the "optimal" label
-                   pred = np.reshape(pred,[image_h,image_w])
+                #pred is the predicted label, var_one is the corresponding variance in terms of the "optimal" label
+                   pred, var_one, entropy, mutual_info = prob_moments.uncertainty_maps()
                     
                 loss_tot.append(loss_per)
                 acc_tot.append(acc_per)
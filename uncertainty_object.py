@@ -0,0 +1,156 @@
+"""
+This file is utilized to calculate the uncertainty maps of Bayesian SegNet from a stack of Monte Carlo dropout
+samples of the softmax output, prob_samples with shape [num_samples, height, width, num_classes].
+Everything is vectorised, so it works for any number of classes and image size.
+"""
+import time
+import numpy as np
+
+EPSILON = 1e-10
+
+
+def class_variance(prob_samples, pred=None):
+    """
+    Variance of the sampled probability of the predicted class for every pixel, [height, width].
+    pred is the predicted label map [height, width], if it is None the argmax of the mean probability is used.
+    """
+    prob_variance = np.var(prob_samples, axis=0)
+    if pred is None:
+        pred = np.argmax(np.mean(prob_samples, axis=0), axis=-1)
+    return _select_class(prob_variance, pred)
+
+
+def predictive_entropy(prob_mean):
+    """
+    Entropy of the mean softmax output for every pixel, [height, width].
+    """
+    return -np.sum(prob_mean * np.log(prob_mean + EPSILON), axis=-1)
+
+
+def expected_entropy(prob_samples):
+    """
+    Mean over the samples of the entropy of every sample, [height, width].
+    """
+    return np.mean(-np.sum(prob_samples * np.log(prob_samples + EPSILON), axis=-1), axis=0)
+
+
+def mutual_information(prob_samples):
+    """
+    Mutual information between the prediction and the model weights (BALD), [height, width]: the predictive entropy
+    minus the expected entropy of the samples.
+    """
+    return predictive_entropy(np.mean(prob_samples, axis=0)) - expected_entropy(prob_samples)
+
+
+def uncertainty_maps(prob_samples):
+    """
+    Input:
+    prob_samples: [num_samples, height, width, num_classes] softmax outputs
+    Output:
+    pred: the predicted label, argmax of the mean probability, [height, width]
+    var_one: the variance of the probability of the predicted label, [height, width]
+    entropy: the predictive entropy, [height, width]
+    mutual_info: the mutual information, [height, width]
+    """
+    prob_mean = np.mean(prob_samples, axis=0)
+    pred = np.argmax(prob_mean, axis=-1)
+    var_one = _select_class(np.var(prob_samples, axis=0), pred)
+    entropy = predictive_entropy(prob_mean)
+    mutual_info = entropy - expected_entropy(prob_samples)
+    return pred, var_one, entropy, mutual_info
+
+
+class RunningMoments(object):
+    """
+    Streaming mean and variance of Monte Carlo samples (Welford's algorithm, merged per batch of samples as in
+    Chan et al.), so only O(height * width * num_classes) floats are kept no matter how many samples are drawn.
+    The mean entropy of the samples is accumulated as well, for the mutual information.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.entropy_sum = None
+        self.last_change = np.inf  # largest change of the predicted class variance in the last update
+
+    def update(self, samples):
+        """
+        samples: [num_new_samples, height, width, num_classes], one or more new samples
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        batch_count = samples.shape[0]
+        batch_mean = np.mean(samples, axis=0)
+        batch_m2 = np.sum(np.square(samples - batch_mean), axis=0)
+        batch_entropy = np.sum(-np.sum(samples * np.log(samples + EPSILON), axis=-1), axis=0)
+        if self.count == 0:
+            self.mean, self.m2, self.entropy_sum = batch_mean, batch_m2, batch_entropy
+            self.count = batch_count
+            return
+        old_var_one = _select_class(self.variance, np.argmax(self.mean, axis=-1))
+        total = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * (float(batch_count) / total)
+        self.m2 += batch_m2 + np.square(delta) * (float(self.count) * batch_count / total)
+        self.entropy_sum += batch_entropy
+        self.count = total
+        new_var_one = _select_class(self.variance, np.argmax(self.mean, axis=-1))
+        self.last_change = np.max(np.abs(new_var_one - old_var_one))
+
+    @property
+    def variance(self):
+        # population variance, the same as np.var of all the samples
+        return self.m2 / self.count
+
+    def converged(self, tolerance, min_samples=2):
+        """
+        True once the per-pixel variance of the predicted class changed less than tolerance in the last update.
+        """
+        return self.count >= min_samples and self.last_change < tolerance
+
+    def uncertainty_maps(self):
+        """
+        The same outputs as the function uncertainty_maps: pred, var_one, entropy, mutual_info.
+        """
+        pred = np.argmax(self.mean, axis=-1)
+        var_one = _select_class(self.variance, pred)
+        entropy = predictive_entropy(self.mean)
+        mutual_info = entropy - self.entropy_sum / self.count
+        return pred, var_one, entropy, mutual_info
+
+
+def _select_class(values, pred):
+    # values [height, width, num_classes], pred [height, width] -> values[h, w, pred[h, w]]
+    num_classes = values.shape[-1]
+    flat_values = np.reshape(values, [-1, num_classes])
+    flat_pred = np.reshape(pred, [-1])
+    return np.reshape(flat_values[np.arange(flat_pred.shape[0]), flat_pred], pred.shape)
+
+
+def benchmark_uncertainty(num_samples=30, image_h=360, image_w=480, num_classes=12):
+    """
+    Compare class_variance with the per-pixel Python loop that was used in SegNet.visual_results and
+    train_test.Test on random samples.
+    """
+    prob_samples = np.random.rand(num_samples, image_h, image_w, num_classes).astype(np.float32)
+    prob_samples /= np.sum(prob_samples, axis=-1, keepdims=True)
+
+    start_time = time.time()
+    prob_variance = np.var(prob_samples, axis=0)
+    pred = np.reshape(np.argmax(np.mean(prob_samples, axis=0), axis=-1), [-1])
+    var_sep = []
+    length_cur = 0
+    for row in np.reshape(prob_variance, [image_h * image_w, num_classes]):
+        var_sep.append(row[pred[length_cur]])
+        length_cur += 1
+    var_loop = np.reshape(var_sep, [image_h, image_w])
+    loop_time = time.time() - start_time
+
+    start_time = time.time()
+    var_vec = class_variance(prob_samples)
+    vec_time = time.time() - start_time
+
+    assert np.allclose(var_loop, var_vec)
+    print('per-pixel variance of %d samples: loop %.3f s, vectorised %.3f s (%.0fx faster)' % (
+        num_samples, loop_time, vec_time, loop_time / vec_time))
+    return loop_time, vec_time
@@ -0,0 +1,171 @@
+"""
+This file is utilized to segment video streams with temporal reuse: consecutive frames of a video are mostly the
+same, so the segmentation of the previous frame is kept where the frame barely changed. The frame is split into a
+grid of tiles, and only the tiles whose mean absolute difference to the last segmented content is above
+VIDEO_CHANGE_THRESHOLD are run through the model again (with VIDEO_CONTEXT pixels of context around them, the
+graph takes any image size). When more than VIDEO_FULL_FRACTION of the tiles changed, the whole frame is run, and
+every VIDEO_MAX_REUSE frames the whole frame is run anyway, so the reused tiles can not drift forever.
+A threshold of 0 runs every frame completely.
+"""
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import scipy.misc
+
+from SegNet import SegNet, read_image
+from evaluation_object import fast_hist, print_hist_summary, hist_metrics
+from inputs_object import get_filename_list
+
+
+class VideoSegmenter(object):
+
+    def __init__(self, model, threshold=None, tile_size=None, context=None, full_fraction=None, max_reuse=None):
+        config = model.config
+        self.model = model
+        self.threshold = config.get("VIDEO_CHANGE_THRESHOLD", 4.0) if threshold is None else threshold
+        self.tile_h, self.tile_w = tile_size or config.get("VIDEO_TILE_SIZE", [90, 120])
+        self.context = config.get("VIDEO_CONTEXT", 32) if context is None else context
+        self.full_fraction = config.get("VIDEO_FULL_FRACTION", 0.5) if full_fraction is None else full_fraction
+        self.max_reuse = config.get("VIDEO_MAX_REUSE", 10) if max_reuse is None else max_reuse
+        self.feed_dict = {model.is_training_pl: False,
+                          model.keep_prob_pl: 1.0,
+                          model.with_dropout_pl: False}
+        self.reset()
+
+    def reset(self):
+        # reference: the content every tile had when it was last segmented, logits: the segmentation of the stream
+        self.reference = None
+        self.logits = None
+        self.frames_since_full = 0
+        self.stats = {"full": 0, "partial": 0, "reused": 0, "tiles_run": 0}
+
+    def segment(self, frame):
+        """
+        Output: label map of frame [height, width, channels], [height, width]
+        """
+        frame = np.asarray(frame, dtype=np.float32)
+        if self.reference is None or frame.shape != self.reference.shape or self.threshold <= 0 \
+                or self.frames_since_full >= self.max_reuse:
+            return self._run_full(frame)
+        changed = self._changed_tiles(frame)
+        if len(changed) == 0:
+            self.stats["reused"] += 1
+        elif len(changed) > self.full_fraction * self._num_tiles(frame):
+            return self._run_full(frame)
+        else:
+            self._run_tiles(frame, changed)
+            self.stats["partial"] += 1
+        self.frames_since_full += 1
+        return np.argmax(self.logits, axis=-1)
+
+    def _run_full(self, frame):
+        self.feed_dict[self.model.inputs_pl] = frame[np.newaxis]
+        self.logits = self.model.sess.run(self.model.logits, feed_dict=self.feed_dict)[0]
+        self.reference = frame.copy()
+        self.frames_since_full = 0
+        self.stats["full"] += 1
+        return np.argmax(self.logits, axis=-1)
+
+    def _num_tiles(self, frame):
+        return int(np.ceil(frame.shape[0] / float(self.tile_h)) * np.ceil(frame.shape[1] / float(self.tile_w)))
+
+    def _changed_tiles(self, frame):
+        # mean absolute difference of every tile, computed on the whole frame at once
+        height, width = frame.shape[:2]
+        pad_h, pad_w = -height % self.tile_h, -width % self.tile_w
+        difference = np.pad(np.mean(np.abs(frame - self.reference), axis=-1), [(0, pad_h), (0, pad_w)], 'constant')
+        tile_difference = difference.reshape(
+            (height + pad_h) // self.tile_h, self.tile_h, (width + pad_w) // self.tile_w, self.tile_w).sum(axis=(1, 3))
+        tile_area = np.outer(np.minimum(self.tile_h, height - np.arange(0, height, self.tile_h)),
+                             np.minimum(self.tile_w, width - np.arange(0, width, self.tile_w)))
+        return np.argwhere(tile_difference / tile_area > self.threshold)
+
+    def _run_tiles(self, frame, changed):
+        # every changed tile is run with context pixels around it, the crops of the same size run as one batch
+        height, width = frame.shape[:2]
+        crops = OrderedDict()
+        for row, col in changed:
+            y0, x0 = row * self.tile_h, col * self.tile_w
+            y1, x1 = min(y0 + self.tile_h, height), min(x0 + self.tile_w, width)
+            crop = (max(y0 - self.context, 0), max(x0 - self.context, 0),
+                    min(y1 + self.context, height), min(x1 + self.context, width))
+            crops.setdefault((crop[2] - crop[0], crop[3] - crop[1]), []).append(((y0, x0, y1, x1), crop))
+        for tiles in crops.values():
+            self.feed_dict[self.model.inputs_pl] = np.stack([frame[cy0:cy1, cx0:cx1]
+                                                             for _, (cy0, cx0, cy1, cx1) in tiles])
+            logits_batch = self.model.sess.run(self.model.logits, feed_dict=self.feed_dict)
+            for ((y0, x0, y1, x1), (cy0, cx0, _, _)), logits in zip(tiles, logits_batch):
+                self.logits[y0:y1, x0:x1] = logits[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+                self.reference[y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+        self.stats["tiles_run"] += len(changed)
+
+
+def sequences(image_filenames, label_filenames):
+    """
+    Split a CamVid list into its video sequences (0001TP, 0006R0, 0016E5, Seq05VD), the frames of every sequence
+    in the order of their frame number. Output: OrderedDict sequence name -> list of (image, label) file names
+    """
+    result = OrderedDict()
+    for image_filename, label_filename in sorted(zip(image_filenames, label_filenames),
+                                                 key=lambda names: os.path.basename(names[0])):
+        name = os.path.basename(image_filename).split("_")[0]
+        result.setdefault(name, []).append((image_filename, label_filename))
+    return result
+
+
+def evaluate_video(segmenter, frames, num_classes):
+    """
+    Segment the frames [(image file, label file)] of one sequence in order. Output: confusion matrix, seconds
+    spent in segment
+    """
+    segmenter.reset()
+    hist = np.zeros((num_classes, num_classes))
+    duration = 0.0
+    for image_filename, label_filename in frames:
+        frame = read_image(image_filename)
+        start_time = time.time()
+        pred = segmenter.segment(frame)
+        duration += time.time() - start_time
+        hist += fast_hist(scipy.misc.imread(label_filename).flatten(), pred.flatten(), num_classes)
+    return hist, duration
+
+
+def video_report(conf_file="config.json", checkpoint=None, thresholds=(0.0, 2.0, 4.0, 8.0)):
+    """
+    Effective fps and mean IU on the sequences of TEST_FILE for every change threshold, the IU loss is relative to
+    threshold 0 (every frame run completely). The labelled CamVid frames are sampled from the videos at a low frame
+    rate (1 Hz for most sequences), so they change much more from one to the next than the frames of a full frame
+    rate stream, the reuse measured here is a lower bound.
+    """
+    model = SegNet(conf_file, config_overrides={"BATCH_SIZE": 1})
+    model.restore(checkpoint)
+    image_filename, label_filename = get_filename_list(model.config["TEST_FILE"], model.config)
+    test_sequences = sequences(image_filename, label_filename)
+    result = {}
+    for threshold in thresholds:
+        segmenter = VideoSegmenter(model, threshold=threshold)
+        hist = np.zeros((model.num_classes, model.num_classes))
+        duration, num_frames = 0.0, 0
+        stats = {"full": 0, "partial": 0, "reused": 0, "tiles_run": 0}
+        for name, frames in test_sequences.items():
+            sequence_hist, sequence_duration = evaluate_video(segmenter, frames, model.num_classes)
+            hist += sequence_hist
+            duration += sequence_duration
+            num_frames += len(frames)
+            for key in stats:
+                stats[key] += segmenter.stats[key]
+        acc_total, _, iu = hist_metrics(hist)
+        result[threshold] = (num_frames / duration, np.nanmean(iu))
+        print("---- threshold %.1f ----" % threshold)
+        print_hist_summary(hist)
+        print("%.2f fps, frames: %d full, %d partial (%d tiles), %d reused" % (
+            num_frames / duration, stats["full"], stats["partial"], stats["tiles_run"], stats["reused"]))
+    if 0.0 in result:
+        for threshold in thresholds:
+            print("threshold %.1f: %.2f fps (%.2fx), mean IU loss %.4f" % (
+                threshold, result[threshold][0], result[threshold][0] / result[0.0][0],
+                result[0.0][1] - result[threshold][1]))
+    model.sess.close()
+    return result